@@ -0,0 +1,740 @@
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import threading
+import configparser
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from urllib.parse import urlparse, unquote
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError, ResourceModifiedError
+from productions import ProductionStore, store_registry
+
+
+# benchmark scales, a production tree 'depth' levels deep, 'width' directories wide at each level with 'files' files of 'file_size' bytes
+# in every directory, in a store holding 'productions' other productions
+SCALES = {
+    'small': {'depth':2, 'width':3, 'files':5, 'file_size':1024 * 1024, 'productions':20},
+    'medium': {'depth':3, 'width':4, 'files':10, 'file_size':16 * 1024 * 1024, 'productions':200},
+    'large': {'depth':4, 'width':5, 'files':20, 'file_size':256 * 1024 * 1024, 'productions':2000},
+}
+
+
+class FakeStorageAccount():
+    # in process stand in for a storage account's Blob and File services. holds the properties of blobs and files (and the data of
+    # small blobs written by the store, such as .production) and sleeps on every request to simulate a round-trip. counts requests,
+    # bytes passing through the client and bytes copied server side
+    def __init__(self, latency=0.002, account_name="benchmark"):
+        self.latency = latency
+        self.account_name = account_name
+        self.credential = SimpleNamespace(account_key=base64.b64encode(b"benchmark-account-key").decode())
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.container_metadata = {}
+        self.shares = {}
+        self.staged_blocks = {}
+        self.clock = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.request_count = 0
+        self.client_bytes = 0
+        self.server_bytes = 0
+
+    def request(self, client_bytes=0, server_bytes=0):
+        with self.lock:
+            self.request_count += 1
+            self.client_bytes += client_bytes
+            self.server_bytes += server_bytes
+        time.sleep(self.latency)
+
+    def now(self):
+        # a timestamp that moves forward on every change, so last modified times always differ
+        with self.lock:
+            self.clock += 1
+            return datetime(2024, 1, 1) + timedelta(seconds=self.clock)
+
+    def blob_service_client(self):
+        return FakeBlobServiceClient(self)
+
+    def get_share(self, share_name):
+        if share_name not in self.shares:
+            self.shares[share_name] = FakeShareClient(self, share_name)
+        return self.shares[share_name]
+
+    def read_source(self, url):
+        # return (size, md5) of the blob or file a SAS url points to, raise if it doesn't exist
+        host, path = urlparse(url).netloc, unquote(urlparse(url).path).lstrip('/')
+        root, _, name = path.partition('/')
+        if '.blob.' in host:
+            blob = self.containers.get(root, {}).get(name)
+            if blob is None:
+                raise ResourceNotFoundError(f"source blob '{path}' not found")
+            return blob['size'], blob['md5']
+        entry = self.get_share(root).find(name)
+        if entry is None or entry['is_directory']:
+            raise ResourceNotFoundError(f"source file '{path}' not found")
+        return entry['size'], entry['md5']
+
+
+class FakePager():
+    # stand in for ItemPaged, one request per page of results
+    def __init__(self, account, items, results_per_page=None):
+        self.account = account
+        self.items = items
+        self.results_per_page = results_per_page or 5000
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self, continuation_token=None):
+        return FakePageIterator(self, int(continuation_token or 0))
+
+
+class FakePageIterator():
+    def __init__(self, pager, start):
+        self.pager = pager
+        self.next_start = start
+        self.continuation_token = None
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        self.pager.account.request()
+        end = self.next_start + self.pager.results_per_page
+        page = self.pager.items[self.next_start:end]
+        self.next_start = end
+        if end < len(self.pager.items):
+            self.continuation_token = str(end)
+        else:
+            self.continuation_token = None
+            self.done = True
+        return page
+
+
+class FakeBlobServiceClient():
+    def __init__(self, account):
+        self.account = account
+        self.account_name = account.account_name
+        self.credential = account.credential
+        self.url = f"https://{account.account_name}.blob.core.windows.net/"
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self.account, str(container))
+
+
+class FakeContainerClient():
+    def __init__(self, account, container_name):
+        self.account = account
+        self.container_name = container_name
+        self.account_name = account.account_name
+        self.url = f"https://{account.account_name}.blob.core.windows.net/{container_name}"
+
+    def blobs(self):
+        if self.container_name not in self.account.containers:
+            raise ResourceNotFoundError(f"container '{self.container_name}' not found")
+        return self.account.containers[self.container_name]
+
+    def create_container(self):
+        self.account.request()
+        if self.container_name in self.account.containers:
+            raise ResourceExistsError(f"container '{self.container_name}' exists")
+        self.account.containers[self.container_name] = {}
+
+    def set_container_metadata(self, metadata=None):
+        self.account.request()
+        self.account.container_metadata[self.container_name] = dict(metadata or {})
+
+    def get_container_properties(self):
+        self.account.request()
+        self.blobs()
+        return SimpleNamespace(metadata=dict(self.account.container_metadata.get(self.container_name, {})))
+
+    def walk_blobs(self, name_starts_with=None, include=None, delimiter='/', results_per_page=None):
+        prefix = name_starts_with or ""
+        items = []
+        seen = set()
+        for name in sorted(self.blobs()):
+            if not name.startswith(prefix):
+                continue
+            head, separator, tail = name[len(prefix):].partition(delimiter)
+            item_name = prefix + head + separator if separator else name
+            if item_name not in seen:
+                seen.add(item_name)
+                items.append(SimpleNamespace(name=item_name))
+        return FakePager(self.account, items, results_per_page)
+
+    def list_blobs(self, name_starts_with=None, include=None, results_per_page=None):
+        prefix = name_starts_with or ""
+        items = [self.get_blob_client(name).properties() for name in sorted(self.blobs()) if name.startswith(prefix)]
+        return FakePager(self.account, items, results_per_page)
+
+    def get_blob_client(self, blob):
+        return FakeBlobClient(self, blob)
+
+    def set_standard_blob_tier_blobs(self, standard_blob_tier, *blobs, rehydrate_priority=None, **kwargs):
+        # one request per batch, an archived blob asked for another tier is marked rehydrating rather than moved straight away
+        self.account.request()
+        responses = []
+        for name in blobs:
+            blob = self.blobs().get(name)
+            if blob is None:
+                responses.append(SimpleNamespace(status_code=404))
+                continue
+            if blob['tier'] == 'Archive' and standard_blob_tier != 'Archive':
+                blob['archive_status'] = f"rehydrate-pending-to-{standard_blob_tier.lower()}"
+            else:
+                blob['tier'] = standard_blob_tier
+            responses.append(SimpleNamespace(status_code=202 if blob['archive_status'] else 200))
+        return iter(responses)
+
+    def upload_blob(self, name, data, metadata=None, overwrite=False, **kwargs):
+        blob_client = self.get_blob_client(name)
+        blob_client.upload_blob(data, metadata=metadata, overwrite=overwrite)
+        return blob_client
+
+
+class FakeBlobClient():
+    def __init__(self, container_client, blob_name):
+        self.account = container_client.account
+        self.container_client = container_client
+        self.blob_name = blob_name
+        self.url = f"{container_client.url}/{blob_name}"
+
+    def blob(self):
+        blob = self.container_client.blobs().get(self.blob_name)
+        if blob is None:
+            raise ResourceNotFoundError(f"blob '{self.blob_name}' not found")
+        return blob
+
+    def write(self, size, md5, data=None, metadata=None):
+        self.container_client.blobs()[self.blob_name] = {'size':size, 'md5':md5, 'data':data, 'metadata':dict(metadata or {}), 'etag':str(self.account.now().timestamp()), 'blocks':0,
+                                                         'tier':'Hot', 'archive_status':None}
+
+    def properties(self):
+        blob = self.blob()
+        return SimpleNamespace(name=self.blob_name, size=blob['size'], metadata=dict(blob['metadata']), etag=blob['etag'], blob_tier=blob['tier'], archive_status=blob['archive_status'],
+                               content_settings=SimpleNamespace(content_type=None, content_md5=blob['md5']), copy=SimpleNamespace(status='success', status_description=None))
+
+    def get_blob_properties(self):
+        self.account.request()
+        return self.properties()
+
+    def upload_blob(self, data, metadata=None, overwrite=False, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.account.request(client_bytes=len(data))
+        if not overwrite and self.blob_name in self.container_client.blobs():
+            raise ResourceExistsError(f"blob '{self.blob_name}' exists")
+        self.write(len(data), bytearray(hashlib.md5(data).digest()), data=data, metadata=metadata)
+
+    def download_blob(self):
+        blob = self.blob()
+        self.account.request(client_bytes=blob['size'])
+        return SimpleNamespace(readall=lambda: bytes(blob['data'] or b""), properties=self.properties())
+
+    def set_blob_metadata(self, metadata=None, etag=None, match_condition=None):
+        self.account.request()
+        blob = self.blob()
+        if etag and etag != blob['etag']:
+            raise ResourceModifiedError(f"blob '{self.blob_name}' changed")
+        blob['metadata'] = dict(metadata or {})
+        blob['etag'] = str(self.account.now().timestamp())
+        return {'etag':blob['etag']}
+
+    def delete_blob(self, etag=None, match_condition=None, **kwargs):
+        self.account.request()
+        blob = self.blob()
+        if etag and etag != blob['etag']:
+            raise ResourceModifiedError(f"blob '{self.blob_name}' changed")
+        del self.container_client.blobs()[self.blob_name]
+
+    def start_copy_from_url(self, source_url, metadata=None, **kwargs):
+        size, md5 = self.account.read_source(source_url)
+        self.account.request(server_bytes=size)
+        self.write(size, md5, metadata=metadata)
+        return {'copy_status':'success'}
+
+    def create_append_blob(self, if_none_match=None, **kwargs):
+        self.account.request()
+        if if_none_match == '*' and self.blob_name in self.container_client.blobs():
+            raise ResourceExistsError(f"blob '{self.blob_name}' exists")
+        self.write(0, None, data=b"")
+
+    def append_block(self, data, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.account.request(client_bytes=len(data))
+        blob = self.blob()
+        blob['data'] += data
+        blob['size'] = len(blob['data'])
+        blob['blocks'] += 1
+        blob['etag'] = str(self.account.now().timestamp())
+        return {'blob_committed_block_count':blob['blocks']}
+
+    def stage_block_from_url(self, block_id, source_url, source_offset=None, source_length=None, **kwargs):
+        size, md5 = self.account.read_source(source_url)
+        self.account.request(server_bytes=source_length)
+        with self.account.lock:
+            self.account.staged_blocks.setdefault((self.container_client.container_name, self.blob_name), {})[block_id] = source_length
+
+    def get_block_list(self, block_list_type="committed", **kwargs):
+        self.account.request()
+        staged = self.account.staged_blocks.get((self.container_client.container_name, self.blob_name))
+        if staged is None and self.blob_name not in self.container_client.blobs():
+            raise ResourceNotFoundError(f"blob '{self.blob_name}' not found")
+        return [], [SimpleNamespace(id=block_id, size=size) for block_id, size in (staged or {}).items()]
+
+    def commit_block_list(self, block_list, content_settings=None, metadata=None, **kwargs):
+        self.account.request()
+        staged = self.account.staged_blocks.pop((self.container_client.container_name, self.blob_name), {})
+        size = sum(staged[block.id] for block in block_list)
+        self.write(size, content_settings.content_md5 if content_settings else None, metadata=metadata)
+
+
+class FakeShareClient():
+    # stand in for a ShareClient, directories hold their entries by name, files hold their size and content MD5. as on Azure Files, a
+    # directory's last modified time doesn't change when files are written to or deleted from it
+    def __init__(self, account, share_name="benchmark"):
+        self.account = account
+        self.share_name = share_name
+        self.account_name = account.account_name
+        self.credential = account.credential
+        self.directories = {"": {'entries':{}, 'last_modified':account.now()}}
+
+    def find(self, path):
+        parent, _, name = path.rpartition('/')
+        directory = self.directories.get(parent)
+        return directory['entries'].get(name) if directory else None
+
+    def add_directory(self, path):
+        # create a directory without making a request, for setting up benchmarks
+        parent, _, name = path.rpartition('/')
+        self.directories[parent]['entries'][name] = {'is_directory':True}
+        self.directories[path] = {'entries':{}, 'last_modified':self.account.now()}
+
+    def add_file(self, path, size=0):
+        # create a file without making a request, for setting up benchmarks
+        parent, _, name = path.rpartition('/')
+        self.directories[parent]['entries'][name] = {'is_directory':False, 'size':size, 'md5':bytearray(hashlib.md5(path.encode("utf-8")).digest()), 'last_modified':self.account.now()}
+
+    def remove_directory(self, path):
+        # remove a directory and everything under it without making a request, for setting up benchmarks
+        for dir_path in [p for p in self.directories if p == path or p.startswith(f"{path}/")]:
+            del self.directories[dir_path]
+        parent, _, name = path.rpartition('/')
+        del self.directories[parent]['entries'][name]
+
+    def move_directory(self, path, new_path):
+        # rename a directory without making a request, for setting up benchmarks
+        for dir_path in sorted(p for p in self.directories if p == path or p.startswith(f"{path}/")):
+            self.directories[new_path + dir_path[len(path):]] = self.directories.pop(dir_path)
+        parent, _, name = path.rpartition('/')
+        new_parent, _, new_name = new_path.rpartition('/')
+        self.directories[new_parent]['entries'][new_name] = self.directories[parent]['entries'].pop(name)
+
+    def list_directories_and_files(self, directory_name=None, include=None, **kwargs):
+        self.account.request()
+        directory = self.directories.get(directory_name or "")
+        if directory is None:
+            raise ResourceNotFoundError(f"directory '{directory_name}' not found")
+        listing = []
+        for name, entry in list(directory['entries'].items()):
+            path = f"{directory_name}/{name}" if directory_name else name
+            if entry['is_directory']:
+                last_modified = self.directories[path]['last_modified']
+            else:
+                last_modified = entry['last_modified']
+            listing.append({'name':name, 'is_directory':entry['is_directory'], 'size':entry.get('size'), 'last_modified':last_modified if include else None})
+        return listing
+
+    def delete_directory(self, directory_name):
+        self.account.request()
+        if self.directories.get(directory_name, {}).get('entries'):
+            raise ResourceExistsError(f"directory '{directory_name}' is not empty")
+        self.remove_directory(directory_name)
+
+    def create_directory(self, directory_name):
+        self.account.request()
+        parent, _, name = directory_name.rpartition('/')
+        if directory_name in self.directories:
+            raise ResourceExistsError(f"directory '{directory_name}' exists")
+        if parent not in self.directories:
+            raise ResourceNotFoundError(f"parent of '{directory_name}' not found")
+        self.add_directory(directory_name)
+
+    def get_directory_client(self, directory_path):
+        def get_directory_properties():
+            self.account.request()
+            if directory_path not in self.directories:
+                raise ResourceNotFoundError(f"directory '{directory_path}' not found")
+            return SimpleNamespace(last_modified=self.directories[directory_path]['last_modified'])
+        return SimpleNamespace(get_directory_properties=get_directory_properties)
+
+    def get_file_client(self, file_path):
+        return FakeFileClient(self, file_path)
+
+
+class FakeFileClient():
+    def __init__(self, share_client, file_path):
+        self.account = share_client.account
+        self.share_client = share_client
+        self.file_path = file_path
+        self.url = f"https://{share_client.account_name}.file.core.windows.net/{share_client.share_name}/{file_path}"
+
+    def write(self, size, md5):
+        parent, _, name = self.file_path.rpartition('/')
+        if parent not in self.share_client.directories:
+            raise ResourceNotFoundError(f"parent of '{self.file_path}' not found")
+        self.share_client.directories[parent]['entries'][name] = {'is_directory':False, 'size':size, 'md5':md5, 'last_modified':self.account.now()}
+
+    def create_file(self, size, content_settings=None, **kwargs):
+        self.account.request()
+        self.write(size, content_settings.content_md5 if content_settings else None)
+
+    def upload_range_from_url(self, source_url, offset, length, source_offset, **kwargs):
+        size, md5 = self.account.read_source(source_url)
+        self.account.request(server_bytes=length)
+        entry = self.share_client.find(self.file_path)
+        entry['md5'] = md5
+        entry['last_modified'] = self.account.now()
+
+    def start_copy_from_url(self, source_url, **kwargs):
+        size, md5 = self.account.read_source(source_url)
+        self.account.request(server_bytes=size)
+        self.write(size, md5)
+        return {'copy_status':'success'}
+
+    def delete_file(self, **kwargs):
+        self.account.request()
+        parent, _, name = self.file_path.rpartition('/')
+        if self.share_client.find(self.file_path) is None:
+            raise ResourceNotFoundError(f"file '{self.file_path}' not found")
+        del self.share_client.directories[parent]['entries'][name]
+
+    def get_file_properties(self):
+        self.account.request()
+        entry = self.share_client.find(self.file_path)
+        if entry is None:
+            raise ResourceNotFoundError(f"file '{self.file_path}' not found")
+        return SimpleNamespace(size=entry['size'], last_modified=entry['last_modified'], etag=str(entry['last_modified'].timestamp()),
+                               content_settings=SimpleNamespace(content_type=None, content_md5=entry['md5']),
+                               copy=SimpleNamespace(status='success', status_description=None))
+
+
+class FakeAsync():
+    # wraps a fake client so its methods are awaited, and its listings iterated with async for, as the aio clients' are
+    listings = ('walk_blobs', 'list_blobs', 'list_directories_and_files')
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+        if name.startswith('get_') and name.endswith('_client'):
+            return lambda *args, **kwargs: FakeAsync(attribute(*args, **kwargs))
+        if name in self.listings:
+            return lambda *args, **kwargs: FakeAsyncIterator(attribute(*args, **kwargs))
+
+        async def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # the downloader's readall is awaited too
+            return FakeAsync(result) if name == 'download_blob' else result
+        return call
+
+
+class FakeAsyncIterator():
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def use_example_config():
+    # load productionstore.cfg.example into store_registry so stores built here don't need a real productionstore.cfg
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'productionstore.cfg.example'))
+    config.set('performance settings', 'registry_ttl', str(24 * 60 * 60))
+    store_registry.clear()
+    store_registry.config = config
+    store_registry.config_loaded = time.monotonic()
+
+
+def make_fake_share(depth, width, files_per_directory, latency=0.01, file_size=0, production_name="production", account=None):
+    # build a share with a production directory containing a tree 'depth' levels deep and 'width' directories wide at each level
+    account = account or FakeStorageAccount(latency=latency)
+    share = account.get_share("benchmark")
+    share.add_directory(production_name)
+    level = [production_name]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for f in range(files_per_directory):
+                share.add_file(f"{parent}/file{f}.mov", size=file_size)
+            for w in range(width):
+                path = f"{parent}/dir{w}"
+                share.add_directory(path)
+                next_level.append(path)
+        level = next_level
+    return share
+
+
+def make_store(share_client, listing_concurrency):
+    # build a ProductionStore around the fake share without connecting to storage
+    production_store = ProductionStore.__new__(ProductionStore)
+    production_store.share_client = share_client
+    production_store.listing_concurrency = listing_concurrency
+    return production_store
+
+
+def make_benchmark_store(account, production_store_name="benchmark"):
+    # build a ProductionStore with the example settings around a fake storage account, with an empty production store container
+    production_store = ProductionStore.__new__(ProductionStore)
+    production_store.load_settings("benchmark-blob", "benchmark-files", "benchmark-store", production_store_name)
+    production_store.blob_service_client = account.blob_service_client()
+    production_store.share_client = account.get_share(production_store_name)
+    account.containers.setdefault("benchmark-store", {})
+    account.container_metadata["benchmark-store"] = production_store.metadata()
+    return production_store
+
+
+def measure(account, operation):
+    # run operation, return its duration, request count and bytes moved
+    account.reset_counters()
+    start = time.perf_counter()
+    operation()
+    return {
+        'seconds':round(time.perf_counter() - start, 4),
+        'requests':account.request_count,
+        'client_bytes':account.client_bytes,
+        'server_bytes':account.server_bytes,
+    }
+
+
+def benchmark_scale(scale_name, depth, width, files, file_size, productions, latency=0.002):
+    # time the store's main operations on a synthetic production against a fake storage account
+    use_example_config()
+    account = FakeStorageAccount(latency=latency)
+    production_store = make_benchmark_store(account)
+    for i in range(productions):
+        production_store.create_production(f"production{i:05d}")
+    production_name = "benchmark"
+    share = make_fake_share(depth, width, files, file_size=file_size, production_name=production_name, account=account)
+    production_store.create_production(production_name, production_tree=[{'name':production_name, 'type':'directory', 'contents':[]}])
+    file_count = sum(1 for directory in share.directories.values() for entry in directory['entries'].values() if not entry['is_directory'])
+    print(f"BENCHMARK: scale '{scale_name}' ({len(share.directories) - 1} directories, {file_count} files, {productions} other productions)")
+
+    operations = {}
+    def run(name, operation):
+        operations[name] = measure(account, operation)
+        print(f"  {name:<36} seconds={operations[name]['seconds']:<8} requests={operations[name]['requests']:<7} client_bytes={operations[name]['client_bytes']:<10} server_bytes={operations[name]['server_bytes']}")
+
+    run('list_productions', production_store.list_productions)
+    run('list_productions_page', lambda: production_store.list_productions_page(page_size=100, include_metadata=True))
+    run('get_wip_production_tree', lambda: production_store.get_wip_production_tree(production_name))
+    run('copy_production_to_blob', lambda: production_store.copy_production_to_blob(production_name))
+    run('copy_production_to_blob_unchanged', lambda: production_store.copy_production_to_blob(production_name))
+    run('get_production_tree', lambda: production_store.get_production_tree(production_name))
+    share.remove_directory(production_name)
+    run('copy_production_to_files', lambda: production_store.copy_production_to_files(production_name))
+    run('update_wip_production_tree', lambda: production_store.update_wip_production_tree(production_name))
+
+    return {'depth':depth, 'width':width, 'files_per_directory':files, 'file_size':file_size, 'productions':productions,
+            'directories':len(share.directories) - 1, 'files':file_count, 'operations':operations}
+
+
+def check_sync_engine():
+    # assert that the sync engine makes the archive, and the stored tree, match the share through new, unchanged, touched, changed, deleted
+    # and renamed files and a restore, so a benchmark can't get faster by getting something wrong
+    use_example_config()
+    account = FakeStorageAccount(latency=0)
+    production_store = make_benchmark_store(account)
+    production_name = "check"
+    share = make_fake_share(2, 2, 3, file_size=1024, production_name=production_name, account=account)
+    share.add_directory(f"{production_name}/Ingest")
+    share.add_file(f"{production_name}/Ingest/upload.mov", size=10)
+    production_store.create_production(production_name, production_tree=[{'name':production_name, 'type':'directory', 'contents':[]}])
+    prefix = f"{production_name}/"
+
+    def archived():
+        return {name[len(prefix):]: blob['size'] for name, blob in account.containers["benchmark-store"].items()
+                if name.startswith(prefix) and production_store.is_archived_file(name[len(prefix):])}
+
+    def on_share():
+        return {f"{dir_path}/{name}"[len(prefix):]: entry['size'] for dir_path, directory in share.directories.items() if dir_path == production_name or dir_path.startswith(prefix)
+                for name, entry in directory['entries'].items() if not entry['is_directory'] and production_store.is_archived_file(f"{dir_path}/{name}"[len(prefix):])}
+
+    def tree_paths(production_tree, parent=""):
+        return {path for node in production_tree for path in [f"{parent}/{node['name']}"] + sorted(tree_paths(node.get('contents', []), f"{parent}/{node['name']}"))}
+
+    def operations(report, operation):
+        return sorted(o['path'] for o in report['operations'] if o['operation'] == operation)
+
+    report = production_store.copy_production_to_blob(production_name)
+    assert report['copy_count'] == len(on_share()) and not report['failed'], "first sync didn't copy every file"
+    assert archived() == on_share(), "archive doesn't match the share after the first sync"
+    assert "Ingest/upload.mov" not in archived(), "a file in the ingest folder was archived"
+    assert tree_paths(production_store.get_production_tree(production_name)) == tree_paths(production_store.get_wip_production_tree(production_name)), "stored tree doesn't match the share"
+    assert production_store.plan_production_to_blob(production_name)['operations'] == [], "unchanged production planned operations"
+
+    share.find(f"{production_name}/file0.mov")['size'] = 2048
+    share.find(f"{production_name}/file0.mov")['last_modified'] = account.now()
+    share.find(f"{production_name}/file1.mov")['last_modified'] = account.now()
+    report = production_store.copy_production_to_blob(production_name, dry_run=True)
+    assert operations(report, 'copy') == ["file0.mov"] and operations(report, 'update_metadata') == ["file1.mov"], "changed and touched files planned wrongly"
+    assert archived()["file0.mov"] == 1024, "dry run changed the archive"
+    production_store.copy_production_to_blob(production_name)
+    assert archived() == on_share(), "archive doesn't match the share after a changed file"
+
+    share.get_file_client(f"{production_name}/file2.mov").delete_file()
+    share.move_directory(f"{production_name}/dir0", f"{production_name}/moved")
+    report = production_store.copy_production_to_blob(production_name)
+    moved = sorted(path for path in on_share() if path.startswith("moved/"))
+    assert operations(report, 'delete') == ["file2.mov"] and operations(report, 'move') == moved and report['copy_count'] == 0, "deleted and renamed files planned wrongly"
+    assert archived() == on_share(), "archive doesn't match the share after deletes and moves"
+    assert tree_paths(production_store.get_production_tree(production_name)) == tree_paths(production_store.get_wip_production_tree(production_name)), "stored tree doesn't match the share after deletes and moves"
+
+    share.remove_directory(production_name)
+    report = production_store.copy_production_to_files(production_name)
+    assert report['copy_count'] == len(archived()) and not report['failed'], "restore didn't copy every archived file"
+    assert on_share() == archived(), "share doesn't match the archive after a restore"
+    print("CHECK: sync engine matches the archive, the stored tree and the share")
+
+
+def check_async_store():
+    import asyncio
+    from productions import AsyncProductionStore
+    # assert that AsyncProductionStore reads and writes the same productions as ProductionStore, and keeps store_registry's metadata
+    # cache right, against one fake account with the fake clients wrapped to be awaited
+    use_example_config()
+    account = FakeStorageAccount(latency=0)
+    production_store = make_benchmark_store(account)
+    async_store = AsyncProductionStore.__new__(AsyncProductionStore)
+    async_store.load_settings("benchmark-blob", "benchmark-files", "benchmark-store", "benchmark")
+    async_store.blob_service_client = FakeAsync(account.blob_service_client())
+    async_store.share_client = FakeAsync(production_store.share_client)
+    production_name = "async"
+    make_fake_share(2, 2, 2, production_name=production_name, account=account)
+
+    def cached_metadata():
+        return store_registry.get_production_metadata(production_store.blob_connection_string, production_store.production_store_id, production_name)
+
+    async def check():
+        await async_store.create_production(production_name)
+        assert await async_store.list_productions() == production_store.list_productions(), "productions listed differently"
+        assert await async_store.get_production_tree(production_name) == production_store.get_production_tree(production_name), "tree read differently"
+        wip_tree = production_store.get_wip_production_tree(production_name)
+        assert await async_store.get_wip_production_tree(production_name) == wip_tree, "WIP directory walked differently"
+
+        production_store.get_production_metadata(production_name)
+        upload_pin = await async_store.set_production_upload_pin(production_name)
+        assert (cached_metadata() or {}).get('upload_pin') == upload_pin, "cached metadata not updated with the new PIN"
+        assert await async_store.get_ingest_url(production_name, upload_pin) == production_store.get_ingest_url(production_name, upload_pin), "ingest URLs differ"
+
+        # a change made by another process, behind the cache, survives a new PIN
+        metadata_blob = account.blob_service_client().get_container_client("benchmark-store").get_blob_client(f"{production_name}/{production_store.metadata_file_name}")
+        metadata_blob.set_blob_metadata(dict(metadata_blob.get_blob_properties().metadata, archive_tier="Cool"))
+        upload_pin = await async_store.set_production_upload_pin(production_name)
+        production_metadata = metadata_blob.get_blob_properties().metadata
+        assert production_metadata.get('archive_tier') == "Cool" and production_metadata['upload_pin'] == upload_pin, "concurrent metadata change overwritten"
+        assert production_store.list_productions_page(include_metadata=True)['productions'] == [{'name':production_name, 'metadata':production_metadata}], "summary not updated"
+
+        await async_store.set_production_tree(production_name, wip_tree)
+        assert cached_metadata() is None, "cached metadata not forgotten when the tree was written"
+        assert production_store.get_production_tree(production_name) == wip_tree, "tree written by the async store read back differently"
+
+    asyncio.run(check())
+    print("CHECK: async store matches the sync store and store_registry")
+
+
+def compare_results(baseline, results, tolerance, slack=0.05):
+    # return a line for every operation that makes more requests, or takes more than tolerance (and slack seconds) longer, than in the baseline
+    regressions = []
+    for scale_name, scale in results['scales'].items():
+        for name, measured in scale['operations'].items():
+            before = baseline.get('scales', {}).get(scale_name, {}).get('operations', {}).get(name)
+            if not before:
+                continue
+            if measured['requests'] > before['requests']:
+                regressions.append(f"{scale_name}/{name}: requests {before['requests']} -> {measured['requests']}")
+            if measured['seconds'] > before['seconds'] * (1 + tolerance) and measured['seconds'] - before['seconds'] > slack:
+                regressions.append(f"{scale_name}/{name}: seconds {before['seconds']} -> {measured['seconds']}")
+    return regressions
+
+
+def benchmark_wip_tree(name, depth, width, files_per_directory, concurrencies=(1, 4, 16, 32)):
+    share = make_fake_share(depth, width, files_per_directory)
+    print(f"BENCHMARK: get_wip_production_tree '{name}' ({len(share.directories)} directories)")
+    baseline_tree = None
+    for concurrency in concurrencies:
+        share.account.reset_counters()
+        production_store = make_store(share, concurrency)
+        start = time.perf_counter()
+        tree = production_store.get_wip_production_tree(production_name="production")
+        elapsed = time.perf_counter() - start
+        if baseline_tree is None:
+            baseline_tree = tree
+        assert tree == baseline_tree, "walker returned a different tree"
+        print(f"  concurrency={concurrency:<3} requests={share.account.request_count:<6} seconds={elapsed:.2f}")
+
+
+def benchmark_store_construction(production_store_id, count=10):
+    # time constructing a store against the configured storage account, cold each time without the cache, then warm from store_registry
+    print(f"BENCHMARK: ProductionStore construction '{production_store_id}'")
+    for use_cache in (False, True):
+        store_registry.clear()
+        timings = [ProductionStore(production_store_id=production_store_id, use_cache=use_cache).construction_time for i in range(count)]
+        print(f"  use_cache={str(use_cache):<5} first={timings[0] * 1000:.1f}ms mean_after_first={sum(timings[1:]) / (count - 1) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the production store against an in process fake storage account")
+    parser.add_argument('--scales', default='small,medium', help=f"comma separated scales to run, from {', '.join(SCALES)}")
+    parser.add_argument('--latency', type=float, default=0.002, help="seconds added to every simulated storage request")
+    parser.add_argument('--output', default='benchmark_results.json', help="file to write the results to as JSON")
+    parser.add_argument('--baseline', help="results JSON from an earlier run, exits with status 1 if any operation regressed")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="fraction an operation may slow down against the baseline")
+    parser.add_argument('--walker', action='store_true', help="also compare WIP tree walker concurrency levels")
+    args = parser.parse_args()
+
+    if args.walker:
+        benchmark_wip_tree("deep", depth=8, width=2, files_per_directory=3)
+        benchmark_wip_tree("wide", depth=3, width=12, files_per_directory=5)
+    # construction needs a real storage account from productionstore.cfg
+    if os.environ.get('BENCHMARK_PRODUCTION_STORE_ID'):
+        benchmark_store_construction(os.environ['BENCHMARK_PRODUCTION_STORE_ID'])
+
+    # a benchmark only counts when the engine it timed is still correct
+    check_sync_engine()
+    check_async_store()
+
+    results = {'created':datetime.utcnow().isoformat(), 'latency':args.latency, 'scales':{}}
+    for scale_name in args.scales.split(','):
+        results['scales'][scale_name] = benchmark_scale(scale_name, latency=args.latency, **SCALES[scale_name])
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print(f"results written to '{args.output}'")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_results(json.load(baseline_file), results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -2,18 +2,628 @@ import logging
 import azure.functions as func
 import uuid
 import configparser
+import contextvars
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
-class ProductionStore():
-    def __init__(self, blob_connection_string=None, file_connection_string=None, production_store_id=None, production_store_name=None):
-        import os
+def read_config():
+    import os
+    # read the production store settings file that sits next to this module
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), 'productionstore.cfg'))
+    return config
+
+class StoreRegistry():
+    # process level cache shared by every store in the process, so a warm Functions invocation can construct a store without reading
+    # the settings file or making any storage requests. holds the parsed settings, storage clients (and so their pooled HTTP sessions)
+    # and production store names looked up from container metadata. settings and names expire after ttl seconds
+    def __init__(self, ttl=300, max_sas_tokens=10000):
+        import threading
+        self.ttl = ttl
+        self.max_sas_tokens = max_sas_tokens
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.config = None
+        self.config_loaded = 0
+        self.clients = {}
+        self.store_names = {}
+        self.production_metadata = {}
+        # least recently used first, so per file tokens for many paths don't build up past max_sas_tokens
+        self.sas_tokens = collections.OrderedDict()
+
+    def get_config(self):
+        import time
+        with self.lock:
+            if self.config is None or time.monotonic() - self.config_loaded > self.ttl:
+                self.config = read_config()
+                self.config_loaded = time.monotonic()
+                self.ttl = self.config.getint('performance settings', 'registry_ttl', fallback=self.ttl)
+            return self.config
+
+    def get_client(self, key, create_client):
+        # return the client cached under key, creating it with create_client() the first time
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = create_client()
+            return self.clients[key]
+
+    def get_store_name(self, connection_string, production_store_id):
+        import time
+        with self.lock:
+            cached = self.store_names.get((connection_string, production_store_id))
+            if cached and time.monotonic() - cached[1] <= self.ttl:
+                return cached[0]
+            return None
+
+    def set_store_name(self, connection_string, production_store_id, production_store_name):
+        import time
+        with self.lock:
+            self.store_names[(connection_string, production_store_id)] = (production_store_name, time.monotonic())
+
+    def get_production_metadata(self, connection_string, production_store_id, production_name, with_etag=False):
+        import time
+        # return a copy of the cached metadata of a production, or (metadata, etag) with_etag, None when it isn't cached or has expired.
+        # reads of the cache are only as fresh as ttl, it isn't checked against the blob. the etag is used to make writes conditional
+        # on the metadata not having changed since it was cached, see ProductionStore.update_production_metadata
+        with self.lock:
+            cached = self.production_metadata.get((connection_string, production_store_id, production_name))
+            if cached and time.monotonic() - cached[2] <= self.ttl:
+                return (dict(cached[0]), cached[1]) if with_etag else dict(cached[0])
+            return None
+
+    def set_production_metadata(self, connection_string, production_store_id, production_name, metadata, etag):
+        import time
+        # cache the metadata read from, or written to, a production's metadata blob along with the blob etag it came from
+        with self.lock:
+            self.production_metadata[(connection_string, production_store_id, production_name)] = (dict(metadata), etag, time.monotonic())
+
+    def forget_production_metadata(self, connection_string, production_store_id, production_name):
+        with self.lock:
+            self.production_metadata.pop((connection_string, production_store_id, production_name), None)
+
+    def get_sas_token(self, key, margin):
+        from datetime import datetime
+        # return the cached SAS token for key while it has more than margin (a timedelta) left before it expires, otherwise None
+        with self.lock:
+            cached = self.sas_tokens.get(key)
+            if cached and datetime.utcnow() + margin < cached[1]:
+                self.sas_tokens.move_to_end(key)
+                return cached[0]
+            return None
+
+    def set_sas_token(self, key, sas_token, expiry):
+        with self.lock:
+            self.sas_tokens[key] = (sas_token, expiry)
+            self.sas_tokens.move_to_end(key)
+            while len(self.sas_tokens) > self.max_sas_tokens:
+                self.sas_tokens.popitem(last=False)
+
+store_registry = StoreRegistry()
+
+# the instrumented ProductionStore method call in progress and the StorageMetrics recording it, storage requests are counted against it
+current_operation = contextvars.ContextVar('current_operation', default=None)
+current_metrics = contextvars.ContextVar('current_metrics', default=None)
+
+def storage_request_hook(pipeline_request):
+    # installed on every instrumented client, which store_registry shares between stores, so requests are passed to whichever
+    # StorageMetrics is recording the call in progress rather than one bound to the client
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.request_hook(pipeline_request)
+
+def storage_response_hook(pipeline_response):
+    metrics = pipeline_response.context.get('metrics')
+    if metrics is not None:
+        metrics.response_hook(pipeline_response)
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    # thread pool that runs every task in a copy of the submitting thread's context, so requests made by workers are counted against
+    # the operation that started them
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+class StorageMetrics():
+    # optional instrumentation for ProductionStore. storage_request_hook and storage_response_hook are installed on the storage clients'
+    # pipelines (as raw_request_hook and raw_response_hook, run once per attempt, after the SDK retry policy) and pass each request made
+    # during an instrumented call to that call's StorageMetrics, which counts requests, retries, throttling responses, errors, latency and
+    # bytes against the ProductionStore method being called. every finished call and every request is passed to each of the sinks. when
+    # no StorageMetrics is set up nothing is installed and methods are not wrapped
+    latency_buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, sinks=None):
+        import threading
+        self.sinks = list(sinks or [MemoryMetricsSink()])
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_names(cls, names):
+        # build from a comma separated list of sink names, e.g. the 'instrumentation' setting 'memory,log'
+        sink_classes = {'memory': MemoryMetricsSink, 'log': LogMetricsSink, 'opentelemetry': OpenTelemetryMetricsSink}
+        return cls([sink_classes[name.strip()]() for name in names.split(',') if name.strip()])
+
+    def sink(self, sink_class):
+        # return the first sink of sink_class, e.g. metrics.sink(MemoryMetricsSink).snapshot()
+        return next((sink for sink in self.sinks if isinstance(sink, sink_class)), None)
+
+    @staticmethod
+    def client_options():
+        # keyword arguments for BlobServiceClient and ShareClient that install the hooks, the same for every StorageMetrics
+        return {'raw_request_hook': storage_request_hook, 'raw_response_hook': storage_response_hook}
+
+    def request_hook(self, pipeline_request):
+        import time
+        context = pipeline_request.context
+        call = current_operation.get()
+        attempt = context.get('metrics_attempt', 0) + 1
+        body = pipeline_request.http_request.body
+        bytes_sent = int(pipeline_request.http_request.headers.get('Content-Length') or (len(body) if isinstance(body, (bytes, str)) else 0))
+        context['metrics'] = self
+        context['metrics_attempt'] = attempt
+        context['metrics_call'] = call
+        context['metrics_bytes_sent'] = bytes_sent
+        context['metrics_start'] = time.perf_counter()
+        if call is not None:
+            with self.lock:
+                call['requests'] += 1
+                call['retries'] += attempt > 1
+                call['bytes_sent'] += bytes_sent
+
+    def response_hook(self, pipeline_response):
+        import time
+        context = pipeline_response.context
+        if 'metrics_start' not in context:
+            return
+        call = context['metrics_call']
+        status = pipeline_response.http_response.status_code
+        # a HEAD response has no body, its Content-Length is the size of the blob or file, e.g. get_blob_properties on a large blob
+        method = pipeline_response.http_request.method
+        bytes_received = 0 if method == 'HEAD' else int(pipeline_response.http_response.headers.get('Content-Length') or 0)
+        request = {
+            'operation':call['operation'] if call else None,
+            'method':method,
+            'status':status,
+            'seconds':time.perf_counter() - context['metrics_start'],
+            'attempt':context['metrics_attempt'],
+            'throttled':status in (429, 503),
+            'bytes_sent':context['metrics_bytes_sent'],
+            'bytes_received':bytes_received,
+        }
+        if call is not None:
+            with self.lock:
+                call['throttled'] += request['throttled']
+                call['errors'] += status >= 400
+                call['bytes_received'] += request['bytes_received']
+                call['latency_ms'][self.latency_bucket(request['seconds'])] += 1
+        for sink in self.sinks:
+            sink.record_request(request)
+
+    @classmethod
+    def latency_bucket(cls, seconds):
+        # index of the histogram bucket for a latency, the last bucket holds everything slower than the largest bound
+        import bisect
+        return bisect.bisect_left(cls.latency_buckets, seconds * 1000)
+
+    def call(self, name, function, *args, **kwargs):
+        import time
+        # call function as the operation name, nested in the operation in progress if there is one, e.g.
+        # 'copy_production_to_blob/refresh_production_tree'
+        parent = current_operation.get()
+        call = {
+            'operation':f"{parent['operation']}/{name}" if parent else name,
+            'failed':False,
+            'requests':0,
+            'retries':0,
+            'throttled':0,
+            'errors':0,
+            'bytes_sent':0,
+            'bytes_received':0,
+            'latency_ms':[0] * (len(self.latency_buckets) + 1),
+        }
+        token = current_operation.set(call)
+        metrics_token = current_metrics.set(self)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            call['failed'] = True
+            raise
+        finally:
+            call['seconds'] = time.perf_counter() - start
+            current_metrics.reset(metrics_token)
+            current_operation.reset(token)
+            if parent is not None:
+                # a call's figures include the requests made by the calls nested in it
+                with self.lock:
+                    for key in ('requests', 'retries', 'throttled', 'errors', 'bytes_sent', 'bytes_received'):
+                        parent[key] += call[key]
+                    parent['latency_ms'] = [a + b for a, b in zip(parent['latency_ms'], call['latency_ms'])]
+            # nested calls that made no requests (tree and plan helpers) aren't worth a record
+            if parent is None or call['requests']:
+                for sink in self.sinks:
+                    sink.record_operation(call)
+
+    def instrument(self, store):
+        import functools
+        # wrap the methods listed in the store's instrumented_methods, those that make storage requests, so their calls are counted.
+        # helpers that only work on names, paths and reports aren't wrapped, and generators are left alone, their requests are counted
+        # against whichever method is iterating them
+        for name in store.instrumented_methods:
+            method = getattr(store, name)
+            setattr(store, name, functools.wraps(method)(functools.partial(self.call, name, method)))
+
+class MemoryMetricsSink():
+    # keeps running totals per operation in process, read them with snapshot()
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.operations = {}
+        self.statuses = {}
+
+    def record_operation(self, call):
+        with self.lock:
+            totals = self.operations.setdefault(call['operation'], {
+                'calls':0, 'failed':0, 'seconds':0.0, 'requests':0, 'retries':0, 'throttled':0, 'errors':0, 'bytes_sent':0, 'bytes_received':0,
+                'latency_ms':[0] * (len(StorageMetrics.latency_buckets) + 1),
+            })
+            totals['calls'] += 1
+            totals['failed'] += call['failed']
+            for key in ('seconds', 'requests', 'retries', 'throttled', 'errors', 'bytes_sent', 'bytes_received'):
+                totals[key] += call[key]
+            totals['latency_ms'] = [a + b for a, b in zip(totals['latency_ms'], call['latency_ms'])]
+
+    def record_request(self, request):
+        with self.lock:
+            statuses = self.statuses.setdefault(request['operation'], {})
+            statuses[request['status']] = statuses.get(request['status'], 0) + 1
+
+    def snapshot(self):
+        import copy
+        # return {'latency_buckets_ms', 'operations': {operation: totals}, 'statuses': {operation: {status: count}}}, latency_ms in the
+        # totals counts requests per bucket of latency_buckets_ms with one more bucket for anything slower
+        with self.lock:
+            return {'latency_buckets_ms':list(StorageMetrics.latency_buckets), 'operations':copy.deepcopy(self.operations), 'statuses':copy.deepcopy(self.statuses)}
+
+class LogMetricsSink():
+    # writes one JSON log line per finished operation, and one per request when the logger is at DEBUG
+    def __init__(self, logger_name='productions.metrics'):
+        self.logger = logging.getLogger(logger_name)
+
+    def record_operation(self, call):
+        import json
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(json.dumps({'event':'operation', **call}))
+
+    def record_request(self, request):
+        import json
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps({'event':'request', **request}))
+
+class OpenTelemetryMetricsSink():
+    # records into OpenTelemetry instruments, exported by whatever MeterProvider the application has configured. needs opentelemetry-api
+    def __init__(self, meter=None):
+        from opentelemetry import metrics
+        meter = meter or metrics.get_meter('productions')
+        self.operation_duration = meter.create_histogram('productionstore.operation.duration', unit='ms', description='duration of ProductionStore operations')
+        self.operation_requests = meter.create_histogram('productionstore.operation.requests', unit='{request}', description='storage requests made per ProductionStore operation')
+        self.request_duration = meter.create_histogram('productionstore.storage.request.duration', unit='ms', description='duration of storage requests')
+        self.requests = meter.create_counter('productionstore.storage.requests', unit='{request}', description='storage requests, including retries')
+        self.retries = meter.create_counter('productionstore.storage.retries', unit='{request}', description='storage requests that were retries')
+        self.throttled = meter.create_counter('productionstore.storage.throttled', unit='{request}', description='storage responses with status 429 or 503')
+        self.bytes_sent = meter.create_counter('productionstore.storage.bytes_sent', unit='By', description='request body bytes sent to storage')
+        self.bytes_received = meter.create_counter('productionstore.storage.bytes_received', unit='By', description='response body bytes received from storage')
+
+    def record_operation(self, call):
+        attributes = {'operation':call['operation'], 'failed':call['failed']}
+        self.operation_duration.record(call['seconds'] * 1000, attributes)
+        self.operation_requests.record(call['requests'], attributes)
+
+    def record_request(self, request):
+        attributes = {'operation':request['operation'] or '', 'http.request.method':request['method'], 'http.response.status_code':request['status']}
+        self.request_duration.record(request['seconds'] * 1000, attributes)
+        self.requests.add(1, attributes)
+        if request['attempt'] > 1:
+            self.retries.add(1, attributes)
+        if request['throttled']:
+            self.throttled.add(1, attributes)
+        self.bytes_sent.add(request['bytes_sent'], attributes)
+        self.bytes_received.add(request['bytes_received'], attributes)
+
+class CompactProductionTree():
+    # flat, versioned form of a production tree as stored in the .production blob. path segments are interned in one list of names and
+    # every node is [parent index, name index, is directory, last modified], parents always come before their children. lookups use an
+    # index of (parent, name) so questions about one path don't build the nested tree. journal records are applied in place, a removed
+    # node is left in the list detached from the tree (parent -2) and skipped by everything else
+    version = 1
+    detached = -2
+
+    def __init__(self, names, nodes):
+        self.names = names
+        self.nodes = nodes
+        self.children = None
+        self.child_index = None
+        self.name_indexes = None
+
+    @classmethod
+    def from_tree(cls, production_tree):
+        names = []
+        name_indexes = {}
+        nodes = []
+        level = [(-1, node) for node in production_tree]
+        while level:
+            next_level = []
+            for parent, node in level:
+                if node['name'] not in name_indexes:
+                    name_indexes[node['name']] = len(names)
+                    names.append(node['name'])
+                nodes.append([parent, name_indexes[node['name']], 1 if node['type'] == 'directory' else 0, node.get('last_modified')])
+                next_level.extend((len(nodes) - 1, child) for child in node.get('contents', []))
+            level = next_level
+        return cls(names, nodes)
+
+    @classmethod
+    def loads(cls, data):
+        import json
+        import zlib
+        # read a tree blob in any format, legacy trees are nested JSON lists, compact trees are a JSON object which may be zlib compressed
+        if data[:1] == b'[':
+            return cls.from_tree(json.loads(data.decode("utf-8")))
+        if data[:1] != b'{':
+            data = zlib.decompress(data)
+        compact_tree = json.loads(data.decode("utf-8"))
+        if compact_tree.get('version', 0) > cls.version:
+            raise ValueError(f"production tree format version {compact_tree.get('version')} is newer than supported version {cls.version}")
+        return cls(compact_tree['names'], compact_tree['nodes'])
+
+    def dumps(self, compress=True):
+        import json
+        import zlib
+        compact_tree = self
+        if any(node[0] == self.detached for node in self.nodes):
+            compact_tree = CompactProductionTree.from_tree(self.to_tree())
+        data = json.dumps({'format':'production_tree', 'version':self.version, 'names':compact_tree.names, 'nodes':compact_tree.nodes}, separators=(',', ':')).encode("utf-8")
+        if compress:
+            return zlib.compress(data)
+        return data
+
+    def to_tree(self):
+        # build the nested list of dicts used everywhere else
+        production_tree = []
+        built = []
+        for parent, name, is_directory, last_modified in self.nodes:
+            if parent == self.detached or (parent != -1 and built[parent] is None):
+                built.append(None)
+                continue
+            node = {'name':self.names[name], 'type':'directory' if is_directory else 'file'}
+            if is_directory:
+                node['contents'] = []
+            if last_modified:
+                node['last_modified'] = last_modified
+            built.append(node)
+            if parent == -1:
+                production_tree.append(node)
+            else:
+                built[parent]['contents'].append(node)
+        return production_tree
+
+    def is_rooted(self, name):
+        # true when the tree has one root, the directory called name
+        return sum(1 for node in self.nodes if node[0] == -1) == 1 and self.nodes[0][2] == 1 and self.names[self.nodes[0][1]] == name
+
+    def build_index(self):
+        # index the children of every node, built on the first lookup
+        self.children = {}
+        self.child_index = {}
+        self.name_indexes = {name: index for index, name in enumerate(self.names)}
+        attached = set()
+        for index, (parent, name, is_directory, last_modified) in enumerate(self.nodes):
+            if parent == self.detached or (parent != -1 and parent not in attached):
+                continue
+            attached.add(index)
+            self.children.setdefault(parent, []).append(index)
+            self.child_index[(parent, self.names[name])] = index
+
+    def add_node(self, parent, node):
+        # append a nested tree node, and everything under it, as a child of the node at index parent
+        level = [(parent, node)]
+        while level:
+            next_level = []
+            for parent, node in level:
+                if node['name'] not in self.name_indexes:
+                    self.name_indexes[node['name']] = len(self.names)
+                    self.names.append(node['name'])
+                index = len(self.nodes)
+                self.nodes.append([parent, self.name_indexes[node['name']], 1 if node['type'] == 'directory' else 0, node.get('last_modified')])
+                self.children.setdefault(parent, []).append(index)
+                self.child_index[(parent, node['name'])] = index
+                next_level.extend((index, child) for child in node.get('contents', []))
+            level = next_level
+
+    def apply_deltas(self, deltas):
+        # apply production tree journal records, as ProductionStoreSettings.apply_tree_deltas does to the nested tree, return self
+        if self.child_index is None:
+            self.build_index()
+        for delta in deltas:
+            parent_path, _, name = delta['path'].rpartition('/')
+            if delta['op'] == 'stamp':
+                index = self.find(delta['path'])
+                if index is not None:
+                    self.nodes[index][3] = delta['last_modified']
+                continue
+            parent = self.find(parent_path)
+            if parent is None or not self.nodes[parent][2]:
+                continue
+            existing = self.child_index.pop((parent, name), None)
+            if existing is not None:
+                self.nodes[existing][0] = self.detached
+                self.children[parent].remove(existing)
+            if delta['op'] == 'add':
+                self.add_node(parent, delta['node'])
+        return self
+
+    def find(self, path):
+        # return the index of the node at path within the production, "" is the production directory itself, None if it isn't in the tree
+        if not self.nodes:
+            return None
+        if self.child_index is None:
+            self.build_index()
+        index = 0
+        for name in [n for n in path.split('/') if n]:
+            index = self.child_index.get((index, name))
+            if index is None:
+                return None
+        return index
+
+    def exists(self, path):
+        return self.find(path) is not None
+
+    def list_directory(self, path):
+        # return [{'name', 'type'}] for the children of the directory at path, None if it isn't in the tree
+        index = self.find(path)
+        if index is None:
+            return None
+        return [{'name':self.names[self.nodes[child][1]], 'type':'directory' if self.nodes[child][2] else 'file'} for child in self.children.get(index, [])]
+
+class TransferTuner():
+    # adapts the chunk size and number of chunks in flight of a chunked transfer to the throughput it sees. the chunk size doubles while
+    # chunks take under two seconds (per request overhead dominates) and halves when they take over eight (a retried or interrupted chunk
+    # loses too much). concurrency climbs while each window of chunks is at least 10% faster than the last, steps back when a window is
+    # 10% slower and halves when storage throttles
+    def __init__(self, chunk_size, min_chunk_size, max_chunk_size, concurrency, max_concurrency):
+        import time
+        import threading
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.chunk_size = max(min_chunk_size, min(chunk_size, max_chunk_size))
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(1, min(concurrency, max_concurrency))
+        self.throughput = None
+        self.lock = threading.Lock()
+        self.window_start = time.perf_counter()
+        self.window_bytes = 0
+        self.window_chunks = 0
+
+    def chunk_done(self, length, seconds):
+        import time
+        with self.lock:
+            if seconds < 2 and length >= self.chunk_size:
+                self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+            elif seconds > 8:
+                self.chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+
+            self.window_bytes += length
+            self.window_chunks += 1
+            if self.window_chunks < self.concurrency:
+                return
+            now = time.perf_counter()
+            throughput = self.window_bytes / max(now - self.window_start, 1e-6)
+            if self.throughput is None or throughput > self.throughput * 1.1:
+                self.concurrency = min(self.concurrency + max(1, self.concurrency // 4), self.max_concurrency)
+            elif throughput < self.throughput * 0.9:
+                self.concurrency = max(1, self.concurrency - max(1, self.concurrency // 5))
+            self.throughput = throughput
+            self.window_start = now
+            self.window_bytes = 0
+            self.window_chunks = 0
+
+    def throttled(self):
+        import time
+        with self.lock:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.window_start = time.perf_counter()
+            self.window_bytes = 0
+            self.window_chunks = 0
+
+class TransferCheckpoint():
+    # manifest of the chunks done of the large file transfers of one production, kept in a blob next to the metadata blob so an interrupted
+    # copy resumes from the chunks already done rather than starting again. loaded on the first transfer, written at most every interval
+    # seconds as chunks complete and whenever a transfer starts or finishes, and deleted once no transfers are left part way through
+    def __init__(self, blob_client, interval):
+        import threading
+        self.blob_client = blob_client
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.stored = False
+        self.saved = 0
+
+    def load(self):
+        import json
+        from azure.core.exceptions import ResourceNotFoundError
+        if self.manifest is None:
+            try:
+                self.manifest = json.loads(self.blob_client.download_blob().readall().decode("utf-8"))
+                self.stored = True
+            except ResourceNotFoundError:
+                self.manifest = {'files':{}}
+
+    def start(self, key, source_etag, size):
+        # return the [offset, length] chunks already done of a transfer, starting it afresh when the source changed since the checkpoint
+        with self.lock:
+            self.load()
+            progress = self.manifest['files'].get(key)
+            if not progress or progress['source_etag'] != source_etag or progress['size'] != size:
+                progress = self.manifest['files'][key] = {'source_etag':source_etag, 'size':size, 'chunks_done':[]}
+            return [list(chunk) for chunk in progress['chunks_done']]
+
+    def set_chunks(self, key, chunks):
+        with self.lock:
+            self.manifest['files'][key]['chunks_done'] = [list(chunk) for chunk in chunks]
+        self.save(force=True)
+
+    def pending(self, prefix):
+        # return the keys under prefix of the transfers part way through, with the prefix removed
+        with self.lock:
+            self.load()
+            return {key[len(prefix):] for key in self.manifest['files'] if key.startswith(prefix)}
+
+    def chunks(self, key):
+        with self.lock:
+            return [list(chunk) for chunk in self.manifest['files'][key]['chunks_done']]
+
+    def chunk_done(self, key, offset, length):
+        with self.lock:
+            self.manifest['files'][key]['chunks_done'].append([offset, length])
+        self.save()
+
+    def finish(self, key):
+        with self.lock:
+            self.manifest['files'].pop(key, None)
+        self.save(force=True)
+
+    def save(self, force=False):
         import json
+        import time
+        from azure.core.exceptions import ResourceNotFoundError
+        with self.lock:
+            if self.manifest is None or not (force or time.monotonic() - self.saved >= self.interval):
+                return
+            if self.manifest['files']:
+                self.blob_client.upload_blob(json.dumps(self.manifest), overwrite=True)
+                self.stored = True
+            elif self.stored:
+                try:
+                    self.blob_client.delete_blob()
+                except ResourceNotFoundError:
+                    pass
+                self.stored = False
+            self.saved = time.monotonic()
+
+class ProductionStoreSettings():
+    # settings and operations shared by ProductionStore and AsyncProductionStore that don't make any storage requests
 
-        config = configparser.RawConfigParser()   
-        config.read(os.path.join(os.path.dirname(__file__), 'productionstore.cfg'))
+    def load_settings(self, blob_connection_string=None, file_connection_string=None, production_store_id=None, production_store_name=None, use_cache=True):
+        import json
 
-        from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient, __version__
-        from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
-        from azure.storage.fileshare import ShareClient, ResourceTypes, AccountSasPermissions
+        self.use_cache = use_cache
+        if use_cache:
+            config = store_registry.get_config()
+        else:
+            config = read_config()
 
         if blob_connection_string:
             self.blob_connection_string = blob_connection_string
@@ -34,12 +644,265 @@ class ProductionStore():
         # global, prefix for ingest location in each production
         self.ingest_prefix = config.get('global settings', 'ingest_path')
 
+        # global, number of directories listed at once when walking the WIP share
+        self.listing_concurrency = config.getint('performance settings', 'listing_concurrency', fallback=16)
+
+        # global, number of files copied or deleted at once by the sync engine
+        self.copy_concurrency = config.getint('performance settings', 'copy_concurrency', fallback=8)
+
+        # global, number of operations run_batch runs at once, and how often and how long to back off when storage is throttling
+        self.batch_concurrency = config.getint('performance settings', 'batch_concurrency', fallback=16)
+        self.batch_retries = config.getint('performance settings', 'batch_retries', fallback=5)
+        self.batch_backoff = config.getfloat('performance settings', 'batch_backoff', fallback=1.0)
+
+        # global, ingest parallelism, range size (put range from URL takes at most 4MiB) and how often progress is checkpointed, in seconds
+        self.ingest_file_concurrency = config.getint('performance settings', 'ingest_file_concurrency', fallback=4)
+        self.ingest_range_concurrency = config.getint('performance settings', 'ingest_range_concurrency', fallback=8)
+        self.ingest_range_size = config.getint('performance settings', 'ingest_range_size', fallback=4 * 1024 * 1024)
+        self.ingest_checkpoint_interval = config.getfloat('performance settings', 'ingest_checkpoint_interval', fallback=10.0)
+
+        # global, number of appends to a production tree journal before it is compacted into the metadata blob
+        self.journal_compact_blocks = config.getint('performance settings', 'journal_compact_blocks', fallback=500)
+
+        # global, compress production trees written to the metadata blob
+        self.tree_compression = config.getboolean('performance settings', 'tree_compression', fallback=True)
+
+        # global, files of at least transfer_threshold bytes are copied in parallel chunks with a checkpoint rather than one server side copy.
+        # the starting block size and number of chunks in flight adapt to throughput, blocks up to transfer_max_block_size, file ranges up to 4MiB
+        self.transfer_threshold = config.getint('performance settings', 'transfer_threshold', fallback=256 * 1024 * 1024)
+        self.transfer_block_size = config.getint('performance settings', 'transfer_block_size', fallback=32 * 1024 * 1024)
+        self.transfer_max_block_size = config.getint('performance settings', 'transfer_max_block_size', fallback=256 * 1024 * 1024)
+        self.transfer_concurrency = config.getint('performance settings', 'transfer_concurrency', fallback=4)
+        self.transfer_max_concurrency = config.getint('performance settings', 'transfer_max_concurrency', fallback=16)
+        self.transfer_checkpoint_interval = config.getfloat('performance settings', 'transfer_checkpoint_interval', fallback=10.0)
+
+        # global, keep a store wide index of archived file contents so duplicates of files of at least dedup_min_size bytes are copied from
+        # an existing blob rather than from the share
+        self.content_index = config.getboolean('performance settings', 'content_index', fallback=True)
+        self.dedup_min_size = config.getint('performance settings', 'dedup_min_size', fallback=1024 * 1024)
+
+        # global, comma separated metrics sinks (memory, log, opentelemetry) ProductionStore records to, empty for no instrumentation
+        self.instrumentation = config.get('performance settings', 'instrumentation', fallback='')
+
         # global, default for directory structures
         self.default_production_tree = json.loads(config.get('production defaults', 'default_tree'))
 
-        # blob storage connection
+        # global, the folders bring_production_online restores when none are asked for, the rest are fetched on demand
+        self.online_folders = [folder.strip() for folder in config.get('production defaults', 'online_folders', fallback='').split(',') if folder.strip()]
+
+    def metadata(self):
+        # return a dict of strings of metadata stored in the object, to be stored as container metadata
+        return dict({
+                'production_store_name': str(self.production_store_name),
+                'production_store_id' : str(self.production_store_id)
+                })
+
+    def add_wip_listing(self, dir_path, contents, file_dir_list):
+        # add the files and directories listed in dir_path to its tree contents, return the (path, contents) of each sub directory still to be listed
+        sub_directories = []
+        for file_or_dir in file_dir_list:
+            name = file_or_dir['name']
+            if not file_or_dir['is_directory']:
+                contents.append({'name':name, 'type':'file'})
+            else:
+                if dir_path != "":
+                    sub_dir_path = f"{dir_path}/{name}"
+                else:
+                    sub_dir_path = name
+                sub_contents = []
+                contents.append({'name':name, 'type':'directory', 'contents':sub_contents})
+                sub_directories.append((sub_dir_path, sub_contents))
+        return sub_directories
+
+    def production_root(self, production_name, production_tree):
+        # return production_tree with the production's own directory at its root, as every tree operation expects. trees given as just
+        # the folders inside the production, like the default_tree setting and trees created from it before, are wrapped in one
+        if len(production_tree) == 1 and production_tree[0]['type'] == 'directory' and production_tree[0]['name'] == production_name:
+            return production_tree
+        return [{'name':production_name, 'type':'directory', 'contents':production_tree}]
+
+    def find_tree_node(self, production_tree, path):
+        # return the node at path within the production, "" is the production directory itself, None if it isn't in the tree
+        node = production_tree[0]
+        for name in [n for n in path.split('/') if n]:
+            node = next((child for child in node.get('contents', []) if child['name'] == name), None)
+            if node is None:
+                return None
+        return node
+
+    def apply_tree_deltas(self, production_tree, deltas):
+        # apply journal records to a production tree in place, records can be applied more than once without changing the result
+        for delta in deltas:
+            parent_path, _, name = delta['path'].rpartition('/')
+            if delta['op'] == 'stamp':
+                # directory stamps are no longer journaled, but may still be in a journal written before
+                node = self.find_tree_node(production_tree, delta['path'])
+                if node is not None:
+                    node['last_modified'] = delta['last_modified']
+                continue
+            parent = self.find_tree_node(production_tree, parent_path)
+            if parent is None or parent['type'] != 'directory':
+                continue
+            contents = parent.setdefault('contents', [])
+            contents[:] = [child for child in contents if child['name'] != name]
+            if delta['op'] == 'add':
+                contents.append(delta['node'])
+        return production_tree
+
+    def encode_production_tree(self, production_tree):
+        # return the bytes stored in the metadata blob for a production tree
+        return CompactProductionTree.from_tree(production_tree).dumps(compress=self.tree_compression)
+
+    def journal_blob_name(self, production_name):
+        # append blob holding the changes made to the production tree since the .production blob was last written
+        return f"{production_name}/{self.metadata_file_name}.journal"
+
+    def summary_prefix(self):
+        # root prefix of the summary blobs, empty blobs holding a copy of each production's metadata so a flat listing of this prefix
+        # returns every production with its metadata. it is a prefix at the root like a production's, but isn't one
+        return f"{self.metadata_file_name}.summary/"
+
+    def summary_blob_name(self, production_name):
+        return f"{self.summary_prefix()}{production_name}"
+
+    def cached_sas_token(self, scope, permission, lifetime, generate_sas):
+        from datetime import datetime
+        # return the SAS token for scope and permission from store_registry, signing a new one with generate_sas(expiry) when there is none
+        # or the cached one is within a tenth of its lifetime of expiring. scope is what the token covers: ('container',) or ('share',) for
+        # the SAS of the whole container or share, whatever URL it signs, and ('blob'|'file', production name, path) for a single one
+        key = (self.blob_connection_string, self.file_connection_string, self.production_store_id, self.production_store_name) + scope + (permission,)
+        sas_token = store_registry.get_sas_token(key, margin=lifetime / 10)
+        if sas_token is None:
+            expiry = datetime.utcnow() + lifetime
+            sas_token = generate_sas(expiry)
+            store_registry.set_sas_token(key, sas_token, expiry)
+        return sas_token
+
+    def get_blob_sas_url(self, production_name=None, path=None, permission="racwdl"):
+        from datetime import timedelta
+        from urllib.parse import quote
+        from azure.storage.blob import generate_container_sas
+        # return a URL for a production, or a prefix in it, signed with a SAS for the production store container only
+
+        account_name = self.blob_service_client.account_name
+        sas_token = self.cached_sas_token(('container',), permission, timedelta(hours=24), lambda expiry: generate_container_sas(
+            account_name,
+            self.production_store_id,
+            account_key=self.blob_service_client.credential.account_key,
+            permission=permission,
+            expiry=expiry,
+        ))
+
+        if path:
+            return f"https://{account_name}.blob.core.windows.net/{self.production_store_id}/{quote(production_name)}/{quote(path)}?{sas_token}"
+        else:
+            return f"https://{account_name}.blob.core.windows.net/{self.production_store_id}/{quote(production_name)}?{sas_token}"
+
+    def get_blob_sas_urls(self, production_name, paths, permission="r"):
+        from datetime import timedelta
+        from urllib.parse import quote
+        from azure.storage.blob import generate_blob_sas
+        # return {path: URL} for files in a production, each signed with a SAS for that blob only, e.g. for download links and thumbnails
+        account_name = self.blob_service_client.account_name
+        account_key = self.blob_service_client.credential.account_key
+        urls = {}
+        for path in paths:
+            blob_name = f"{production_name}/{path}"
+            sas_token = self.cached_sas_token(('blob', production_name, path), permission, timedelta(hours=24), lambda expiry: generate_blob_sas(
+                account_name,
+                self.production_store_id,
+                blob_name,
+                account_key=account_key,
+                permission=permission,
+                expiry=expiry,
+            ))
+            urls[path] = f"https://{account_name}.blob.core.windows.net/{self.production_store_id}/{quote(blob_name)}?{sas_token}"
+        return urls
+
+    def get_files_sas_url(self, production_name=None, path=None, permission="rcwdl"):
+        from datetime import timedelta
+        from urllib.parse import quote
+        from azure.storage.fileshare import generate_share_sas
+        # return a URL for the production store share, a production or a path in it, signed with a SAS for the share only
+
+        account_name = self.share_client.account_name
+        sas_token = self.cached_sas_token(('share',), permission, timedelta(hours=1), lambda expiry: generate_share_sas(
+            account_name,
+            self.production_store_name,
+            account_key=self.share_client.credential.account_key,
+            permission=permission,
+            expiry=expiry,
+            protocol='https',
+        ))
+        if production_name and path:
+            return f"https://{account_name}.file.core.windows.net/{self.production_store_name}/{quote(production_name)}/{quote(path)}?{sas_token}"
+        elif production_name and not path:
+            return f"https://{account_name}.file.core.windows.net/{self.production_store_name}/{quote(production_name)}?{sas_token}"
+        elif path and not production_name:
+            logging.error("must pass 'production name' parameter wwith 'path' parameter")
+        else:
+            return f"https://{account_name}.file.core.windows.net/{self.production_store_name}?{sas_token}"
+
+    def get_files_sas_urls(self, production_name, paths, permission="r"):
+        from datetime import timedelta
+        from urllib.parse import quote
+        from azure.storage.fileshare import generate_file_sas
+        # return {path: URL} for files in a production on the WIP share, each signed with a SAS for that file only
+        account_name = self.share_client.account_name
+        account_key = self.share_client.credential.account_key
+        urls = {}
+        for path in paths:
+            file_path = f"{production_name}/{path}"
+            sas_token = self.cached_sas_token(('file', production_name, path), permission, timedelta(hours=1), lambda expiry: generate_file_sas(
+                account_name,
+                self.production_store_name,
+                file_path.split('/'),
+                account_key=account_key,
+                permission=permission,
+                expiry=expiry,
+                protocol='https',
+            ))
+            urls[path] = f"https://{account_name}.file.core.windows.net/{self.production_store_name}/{quote(file_path)}?{sas_token}"
+        return urls
+
+class ProductionStore(ProductionStoreSettings):
+    # methods that make storage requests, wrapped by StorageMetrics.instrument when instrumentation is on
+    instrumented_methods = (
+        'get_production_store', 'create_production_store', 'list_productions', 'list_productions_page', 'set_production_summary',
+        'rebuild_production_summaries', 'create_production',
+        'get_production_metadata', 'get_production_tree', 'get_production_tree_index', 'production_path_exists', 'list_production_directory',
+        'set_production_tree', 'get_production_tree_deltas', 'append_production_tree_deltas', 'compact_production_tree', 'refresh_production_tree',
+        'set_production_upload_pin', 'get_ingest_url', 'update_wip_production_tree', 'get_wip_production_tree', 'get_wip_directory',
+        'list_wip_files', 'list_production_blobs', 'plan_production_to_blob', 'detect_moves', 'plan_production_to_files', 'wait_for_copy',
+        'sync_production_to_blob', 'sync_production_to_files', 'transfer_file_to_blob', 'transfer_blob_to_file', 'get_ingest_checkpoint',
+        'set_ingest_checkpoint', 'ingest_production', 'copy_production_to_blob', 'copy_production_to_files', 'update_production_metadata',
+        'set_restored_last_modified', 'get_production_online_paths', 'set_production_blob_tiers', 'bring_production_online', 'fetch_production_files', 'take_production_offline',
+        'remove_archived_wip_files', 'get_production_lifecycle', 'get_content_index', 'set_content_index', 'update_content_index',
+        'rebuild_content_index', 'find_duplicates', 'copy_duplicate', 'index_sync_operations', 'get_duplicate_report', 'run_batch',
+    )
+
+    def __init__(self, blob_connection_string=None, file_connection_string=None, production_store_id=None, production_store_name=None, use_cache=True, metrics=None):
+        import time
+        from azure.storage.blob import BlobServiceClient
+        from azure.storage.fileshare import ShareClient
+
+        construction_start = time.perf_counter()
+        self.load_settings(blob_connection_string, file_connection_string, production_store_id, production_store_name, use_cache)
+
+        # instrumentation, a StorageMetrics passed in or one shared by the process built from the 'instrumentation' setting
+        if metrics is None and self.instrumentation:
+            metrics = store_registry.get_client(('metrics', self.instrumentation), lambda: StorageMetrics.from_names(self.instrumentation))
+        self.metrics = metrics
+        client_options = metrics.client_options() if metrics else {}
+        if metrics:
+            metrics.instrument(self)
+
+        # blob storage connection
         logging.info("init connection to blob storage")
-        self.blob_service_client = BlobServiceClient.from_connection_string(self.blob_connection_string)
+        if use_cache:
+            self.blob_service_client = store_registry.get_client(('blob', self.blob_connection_string, bool(metrics)), lambda: BlobServiceClient.from_connection_string(self.blob_connection_string, **client_options))
+        else:
+            self.blob_service_client = BlobServiceClient.from_connection_string(self.blob_connection_string, **client_options)
 
         if production_store_id:
             self.get_production_store()
@@ -48,22 +911,27 @@ class ProductionStore():
 
         # file service connetion
         logging.info("init connection to file service")
-        self.share_client = ShareClient.from_connection_string(self.file_connection_string, share_name=self.production_store_name)
+        if use_cache:
+            self.share_client = store_registry.get_client(('share', self.file_connection_string, self.production_store_name, bool(metrics)), lambda: ShareClient.from_connection_string(self.file_connection_string, share_name=self.production_store_name, **client_options))
+        else:
+            self.share_client = ShareClient.from_connection_string(self.file_connection_string, share_name=self.production_store_name, **client_options)
 
-            
-    def metadata(self):
-        # return a dict of strings of metadata stored in the object, to be stored as container metadata
-        return dict({
-                'production_store_name': str(self.production_store_name),
-                'production_store_id' : str(self.production_store_id)
-                })
+        self.construction_time = time.perf_counter() - construction_start
+        logging.info(f"ProductionStore '{self.production_store_id}' constructed in {self.construction_time * 1000:.1f}ms (use_cache={use_cache})")
 
     def get_production_store(self):
-        # Read a 'Production Store' container and it's metadata
+        # Read a 'Production Store' container and it's metadata, the name is taken from the process cache when it has been looked up recently
+        if self.use_cache:
+            production_store_name = store_registry.get_store_name(self.blob_connection_string, self.production_store_id)
+            if production_store_name:
+                self.production_store_name = production_store_name
+                return
+
         container_client = self.blob_service_client.get_container_client(self.production_store_id)
         container_properties = container_client.get_container_properties()
         try:
             self.production_store_name = container_properties.metadata['production_store_name']
+            store_registry.set_store_name(self.blob_connection_string, self.production_store_id, self.production_store_name)
         except:
             logging.error("Error")
 
@@ -84,6 +952,7 @@ class ProductionStore():
                 logging.error(f"Container '{self.production_store_id}' named already exists")
     
             container_client.set_container_metadata(metadata=self.metadata())
+            store_registry.set_store_name(self.blob_connection_string, self.production_store_id, self.production_store_name)
         else:
             logging.error("Missing parameter: production_store_name")
     
@@ -92,26 +961,72 @@ class ProductionStore():
         blob_list = container_client.walk_blobs()
         productions = []
         for blob in blob_list:
-            productions.append(blob.name[:-1])
+            # blobs at the root of the container, such as the content index, and the summary prefix aren't productions
+            if blob.name.endswith('/') and blob.name != self.summary_prefix():
+                productions.append(blob.name[:-1])
         return productions
 
+    def list_productions_page(self, name_prefix="", page_size=100, continuation_token=None, include_metadata=False):
+        # return one page of productions whose names start with name_prefix and the token for the next page, None on the last page, each
+        # page is one listing request. with include_metadata each production is returned as {'name', 'metadata'}, listed from the summary
+        # blobs: a summary is written after every change to a production's metadata, so it shows changes made by any process, though one
+        # of two changes racing from different processes may only show once the production's metadata next changes. productions created
+        # before summaries were written are only listed with metadata once rebuild_production_summaries has run
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        if include_metadata:
+            prefix = self.summary_prefix()
+            pages = container_client.list_blobs(name_starts_with=prefix + name_prefix, include=['metadata'], results_per_page=page_size).by_page(continuation_token=continuation_token)
+            productions = [{'name':blob.name[len(prefix):], 'metadata':blob.metadata} for blob in next(pages)]
+            return {'productions':productions, 'continuation_token':pages.continuation_token}
+        pages = container_client.walk_blobs(name_starts_with=name_prefix or None, results_per_page=page_size).by_page(continuation_token=continuation_token)
+        production_names = [blob.name[:-1] for blob in next(pages) if blob.name.endswith('/') and blob.name != self.summary_prefix()]
+        return {'productions':production_names, 'continuation_token':pages.continuation_token}
+
+    def set_production_summary(self, production_name, production_metadata):
+        from azure.core.exceptions import HttpResponseError
+        # write the summary blob listed by list_productions_page, the metadata blob stays the record so a failed write is only logged
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        try:
+            container_client.upload_blob(name=self.summary_blob_name(production_name), data=b"", metadata=production_metadata, overwrite=True)
+        except HttpResponseError as e:
+            logging.warning(f"summary of production '{production_name}' not updated: '{e}'")
+
+    def rebuild_production_summaries(self):
+        # write the summary of every production from its metadata blob, for productions created before summaries were kept or whose summary
+        # missed a change. return the number of summaries written
+        from azure.core.exceptions import ResourceNotFoundError
+        production_names = self.list_productions()
+
+        def write_summary(production_name):
+            try:
+                self.set_production_summary(production_name, self.get_production_metadata(production_name))
+                return True
+            except ResourceNotFoundError:
+                return False
+
+        with ContextThreadPoolExecutor(max_workers=self.listing_concurrency) as executor:
+            written = sum(executor.map(write_summary, production_names))
+        logging.info(f"wrote the summaries of {written} productions")
+        return written
+
     def create_production(self, production_name, production_tree=None):
-        import json
         # create a Production by creating an prefix in the container, containging one file named '.production' that file will contain metadata of the Production as Blob metadata, and contain a complete listing of the directory it is sycning from Files. 
+        from azure.core.exceptions import ResourceExistsError
         production_id = str(uuid.uuid4())
         container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
         logging.info("creating projection named '{production_name}'")
         try:
             if production_tree:
-                blob_data = json.dump(production_tree)
+                blob_data = self.encode_production_tree(self.production_root(production_name, production_tree))
             else:
                 # use the class default production
-                blob_data = json.dumps(self.default_production_tree)
+                blob_data = self.encode_production_tree(self.production_root(production_name, self.default_production_tree))
 
             production_metadata = {"production_id":production_id, "online":"False"}
             blob_name = f"{production_name}/{self.metadata_file_name}"
             metadata_blob = container_client.upload_blob(data=blob_data, name=blob_name, metadata=production_metadata)
-        except azure.core.exceptions.ResourceExistsError:
+            self.set_production_summary(production_name, production_metadata)
+        except ResourceExistsError:
             logging.error(f"The production named '{production_name}' already exists.")
 
     def get_production_metadata(self, production_name):
@@ -121,80 +1036,205 @@ class ProductionStore():
             container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
             metadata_blob_name = f"{production_name}/{self.metadata_file_name}"
             metadata_blob_client = container_client.get_blob_client(metadata_blob_name)
-            return metadata_blob_client.get_blob_properties().metadata
+            properties = metadata_blob_client.get_blob_properties()
+            store_registry.set_production_metadata(self.blob_connection_string, self.production_store_id, production_name, properties.metadata, properties.etag)
+            return properties.metadata
         except ResourceNotFoundError as e:
             logging.error(f"metadata blob: '{metadata_blob_name}' for production '{production_name}' is missing")
             raise e
 
-    def get_production_tree(self, production_name):
-        import json
+    def get_production_tree(self, production_name, journal=None):
         # return the tree from the production medata blob about a production
+        # the journal is read before the tree, so a compaction in between leaves records that are already in the tree rather than a tree
+        # missing them. journal, when given, is filled in with the 'etag' of the journal read, None when there was none
         from azure.core.exceptions import ResourceNotFoundError
+        deltas, journal_etag = self.get_production_tree_deltas(production_name, with_etag=True)
+        if journal is not None:
+            journal['etag'] = journal_etag
         try:
             container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
             metadata_blob_name = f"{production_name}/{self.metadata_file_name}"
             metadata_blob_client = container_client.get_blob_client(metadata_blob_name)
-            production_tree_json = metadata_blob_client.download_blob().readall()
-            production_tree = json.loads(production_tree_json.decode("utf-8"))
-            return production_tree
+            production_tree = self.production_root(production_name, CompactProductionTree.loads(metadata_blob_client.download_blob().readall()).to_tree())
+            # apply any changes journaled since the tree was last written in full
+            return self.apply_tree_deltas(production_tree, deltas)
         except ResourceNotFoundError as e:
             logging.error(f"metadata blob: '{metadata_blob_name}' for production '{production_name}' is missing")
             raise e
 
-    def set_production_tree(self, production_name, production_tree):
-        # TODO write the tree back to a metadata blob
-        import json
+    def get_production_tree_index(self, production_name):
+        # return the production tree as a CompactProductionTree, for lookups that don't need the nested tree
+        from azure.core.exceptions import ResourceNotFoundError
+        # the journal is read first, as in get_production_tree
+        deltas = self.get_production_tree_deltas(production_name)
+        try:
+            container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+            metadata_blob_name = f"{production_name}/{self.metadata_file_name}"
+            compact_tree = CompactProductionTree.loads(container_client.get_blob_client(metadata_blob_name).download_blob().readall())
+        except ResourceNotFoundError as e:
+            logging.error(f"metadata blob: '{metadata_blob_name}' for production '{production_name}' is missing")
+            raise e
+        if not compact_tree.is_rooted(production_name):
+            compact_tree = CompactProductionTree.from_tree(self.production_root(production_name, compact_tree.to_tree()))
+        # journaled changes are applied to the compact tree, the nested tree is never built
+        return compact_tree.apply_deltas(deltas)
+
+    def production_path_exists(self, production_name, path):
+        # return True when path within the production is in the stored tree
+        return self.get_production_tree_index(production_name).exists(path)
+
+    def list_production_directory(self, production_name, path=""):
+        # return the children of a directory in the stored tree, None if the directory isn't in the tree
+        return self.get_production_tree_index(production_name).list_directory(path)
+
+    def set_production_tree(self, production_name, production_tree, journal=None):
+        # write the whole tree back to the metadata blob
+        # journal, as filled in by get_production_tree when the tree was read, means the tree holds only the changes journaled up to then:
+        # the journal is removed only when it hasn't changed since, otherwise it is kept and its records applied again on read. without
+        # it the tree replaces whatever was journaled
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceNotFoundError, ResourceModifiedError
         container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
         production_metadata = self.get_production_metadata(production_name)
-        blob_data = json.dumps(production_tree)
+        blob_data = self.encode_production_tree(production_tree)
         blob_name = f"{production_name}/{self.metadata_file_name}"
         metadata_blob = container_client.upload_blob(data=blob_data, name=blob_name, metadata=production_metadata, overwrite=True)
+        store_registry.forget_production_metadata(self.blob_connection_string, self.production_store_id, production_name)
+        if journal is not None and not journal.get('etag'):
+            return
+        journal_client = container_client.get_blob_client(self.journal_blob_name(production_name))
+        try:
+            if journal is not None:
+                journal_client.delete_blob(etag=journal['etag'], match_condition=MatchConditions.IfNotModified)
+            else:
+                journal_client.delete_blob()
+        except ResourceNotFoundError:
+            pass
+        except ResourceModifiedError:
+            logging.info(f"tree journal of production '{production_name}' changed while it was compacted, kept")
+
+    def get_production_tree_deltas(self, production_name, with_etag=False):
+        import json
+        from azure.core.exceptions import ResourceNotFoundError
+        # return the records in the production's tree journal, an empty list when nothing has been journaled since the last full write
+        # with_etag returns (records, etag of the journal), None when there is no journal
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        try:
+            downloader = container_client.get_blob_client(self.journal_blob_name(production_name)).download_blob()
+        except ResourceNotFoundError:
+            return ([], None) if with_etag else []
+        deltas = [json.loads(line) for line in downloader.readall().decode("utf-8").splitlines() if line]
+        return (deltas, downloader.properties.etag) if with_etag else deltas
+
+    def append_production_tree_deltas(self, production_name, deltas):
+        import json
+        from azure.core.exceptions import ResourceExistsError
+        # append change records to the production's tree journal, compacting it into the .production blob once it holds journal_compact_blocks appends
+        if not deltas:
+            return
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        journal_client = container_client.get_blob_client(self.journal_blob_name(production_name))
+        try:
+            journal_client.create_append_blob(if_none_match='*')
+        except ResourceExistsError:
+            pass
+        result = journal_client.append_block(''.join(json.dumps(delta) + '\n' for delta in deltas))
+        logging.info(f"journaled {len(deltas)} tree changes for production '{production_name}'")
+        if int(result['blob_committed_block_count']) >= self.journal_compact_blocks:
+            self.compact_production_tree(production_name)
+
+    def compact_production_tree(self, production_name):
+        # fold the journal into the .production blob, set_production_tree removes the journal once the full tree is written unless
+        # something was appended to it in the meantime
+        logging.info(f"compacting tree journal for production '{production_name}'")
+        journal = {}
+        self.set_production_tree(production_name, self.get_production_tree(production_name, journal=journal), journal=journal)
+
+    def refresh_production_tree(self, production_name, listings=None):
+        # bring the stored tree up to date with the WIP directory, journaling only the changes rather than rewriting the whole tree.
+        # listings, {directory path on the share: listing} of the whole production as filled in by list_wip_files, saves listing the share
+        # again right after a sync. a production may be only partly on the share, so files missing from it are only removed from the tree
+        # when they aren't archived either. returns the refreshed tree
+        production_tree = self.get_production_tree(production_name)
+        if listings is None:
+            listings = dict(self.walk_wip_directory(production_name, missing_ok=True))
+
+        # archived files and every folder holding one
+        archived = set()
+        for path in self.list_production_blobs(production_name):
+            parts = path.split('/')
+            archived.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+
+        def share_path(dir_path):
+            return f"{production_name}/{dir_path}" if dir_path else production_name
+
+        def listed_node(path, file_or_dir):
+            # the tree node for something on the share that isn't in the stored tree, with everything under it
+            if not file_or_dir['is_directory']:
+                return {'name':file_or_dir['name'], 'type':'file'}
+            return {'name':file_or_dir['name'], 'type':'directory', 'contents':[listed_node(f"{path}/{child['name']}", child) for child in listings.get(share_path(path), [])]}
+
+        deltas = []
+
+        def remove_unarchived(path, node):
+            # journal the removal of a node missing from the share, a directory holding archived files keeps those files
+            if path not in archived:
+                deltas.append({'op':'remove', 'path':path})
+            elif node['type'] == 'directory':
+                for child in node.get('contents', []):
+                    remove_unarchived(f"{path}/{child['name']}", child)
+
+        level = [("", production_tree[0])]
+        while level:
+            next_level = []
+            for dir_path, node in level:
+                listing = listings.get(share_path(dir_path))
+                if listing is None:
+                    continue
+                stored = {child['name']: child for child in node.get('contents', [])}
+                listed = {file_or_dir['name']: file_or_dir for file_or_dir in listing}
+                for name, child in stored.items():
+                    child_path = f"{dir_path}/{name}" if dir_path else name
+                    if name not in listed:
+                        remove_unarchived(child_path, child)
+                    elif listed[name]['is_directory'] != (child['type'] == 'directory'):
+                        deltas.append({'op':'remove', 'path':child_path})
+                    elif child['type'] == 'directory':
+                        next_level.append((child_path, child))
+                for name, file_or_dir in listed.items():
+                    child = stored.get(name)
+                    if child is None or file_or_dir['is_directory'] != (child['type'] == 'directory'):
+                        child_path = f"{dir_path}/{name}" if dir_path else name
+                        deltas.append({'op':'add', 'path':child_path, 'node':listed_node(child_path, file_or_dir)})
+            level = next_level
+        logging.info(f"{len(deltas)} changes to the tree of production '{production_name}'")
+
+        self.apply_tree_deltas(production_tree, deltas)
+        self.append_production_tree_deltas(production_name, deltas)
+        return production_tree
 
     def set_production_upload_pin(self, production_name):
         from random import choice
         from string import digits
         from azure.core.exceptions import ResourceExistsError
-        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
         # return a PIN to obtain a upload link, this is stored in metadata on the .metadata blon and verified with verify_production_upload_pin which returns the URL to the Ingest prefix on the blob
         upload_pin = ''.join(choice(digits) for i in range(6))
         try:
-            metadata_blob_client = container_client.get_blob_client(f"{production_name}/{self.metadata_file_name}")
-            production_metadata = metadata_blob_client.get_blob_properties().metadata
-            production_metadata['upload_pin'] = upload_pin
-            metadata_blob_client.set_blob_metadata(metadata=production_metadata)
+            self.update_production_metadata(production_name, {'upload_pin':upload_pin})
             return upload_pin
         except ResourceExistsError as e:
             logging.error(f"The production named '{production_name}' already exists.")
             raise e
 
-    def get_blob_sas_url(self, production_name=None, path=None):
-        from datetime import datetime, timedelta
-        from azure.storage.blob import generate_account_sas, generate_container_sas, ResourceTypes, AccountSasPermissions
-
-        container_client = self.blob_service_client.get_container_client(self.production_store_id)
-
-        sas_token = generate_account_sas(
-            container_client.account_name,
-            resource_types=ResourceTypes(service=True, object=True, container=True),
-            permission=AccountSasPermissions(read=True, write=True, delete=True, list=True, add=True, create=True, update=True, process=True, delete_previous_version=False),
-            expiry=datetime.utcnow() + timedelta(hours=24),
-            account_key=self.blob_service_client.credential.account_key,
-        )
-
-        if path:
-            return f"https://{container_client.account_name}.blob.core.windows.net/{self.production_store_id}/{production_name}/{path}?{sas_token}"
-        else:
-            return f"https://{container_client.account_name}.blob.core.windows.net/{self.production_store_id}/{production_name}?{sas_token}"
-
-
     def get_ingest_url(self, production_name, pin):
         # verity upload pin, return URL
         # try:
         logging.info(f"getting metadata for production '{production_name}'")
         production_metadata = self.get_production_metadata(production_name)
         if pin == production_metadata['upload_pin']:
-            #pin matches, return URL
-            return self.get_blob_sas_url(production_name=production_name, path=self.ingest_prefix)
+            #pin matches, return URL. the SAS covers the whole container, so uploaders can only create new blobs with it, not overwrite,
+            #list, read or delete what is archived
+            return self.get_blob_sas_url(production_name=production_name, path=self.ingest_prefix, permission="c")
         else:
             logging.error("Upload PIN missmatch")
         # except:
@@ -205,163 +1245,1509 @@ class ProductionStore():
     def update_wip_production_tree(self, production_name):
         from azure.core.exceptions import ResourceExistsError
         # create any directories in the WIP directory from the tree stored as metadata on the production
-        
+        # the directories already on the share are listed first and only the missing ones are created, a level at a time so parents
+        # exist before their children, with the siblings in a level created in parallel
+
         # get the tree from the production metadata blob
         production_tree = self.get_production_tree(production_name)
 
-        #print(production_tree)
+        # the path on the share of every directory in the tree, grouped by depth
+        levels = []
+        level = [(production_name, production_tree[0])] # production tree will only contain one directory at the root
+        while level:
+            levels.append([dir_path for dir_path, node in level])
+            level = [(f"{dir_path}/{child['name']}", child) for dir_path, node in level for child in node.get('contents', []) if child['type'] == 'directory']
 
-        # create folders in the files location
         logging.info(f"Creating production directory '{production_name}'")
         try:
-            directory_client = self.share_client.create_directory(directory_name=production_name)
+            self.share_client.create_directory(directory_name=production_name)
+            existing = {production_name}
         except ResourceExistsError:
-            print(f"Directory '{production_name}'exists, skipping")
-            directory_client = self.share_client.get_directory_client(directory_path=production_name)
-        
-        self.create_wip_directory(directory_client=directory_client, sub_tree=production_tree[0]['contents']) # production tree will only contain one directory at the root
-        
+            logging.info(f"Directory '{production_name}' exists, listing existing directories")
+            existing = {dir_path for dir_path, file_dir_list in self.walk_wip_directory(production_name)}
 
-    def create_wip_directory(self, directory_client, sub_tree):
-        print(">>>> CREATING SUBTREE")
-        print(directory_client.directory_path)
-        print(sub_tree)
-        from azure.core.exceptions import ResourceExistsError 
-        # iterable function to reate subdirectories on the file shares
-        for file_or_dir in sub_tree:
-            if file_or_dir['type'] == 'directory':
-                logging.info(f"Creating sub directory '{file_or_dir['name']}'")
-                try:
-                    directory_name = file_or_dir['name']
-                    new_directory_client = directory_client.create_subdirectory(directory_name=directory_name)
-                except ResourceExistsError:
-                    logging.info(f"Directory '{directory_name}' exists, skipping")
-                    new_directory_client = directory_client.get_subdirectory_client(directory_name=directory_name)
+        def create_directory(dir_path):
+            try:
+                self.share_client.create_directory(directory_name=dir_path)
+            except ResourceExistsError:
+                logging.info(f"Directory '{dir_path}' exists, skipping")
 
-                # if the directory is not empty, then recurse into it
-                if 'contents' in file_or_dir:
-                    self.create_wip_directory(directory_client=new_directory_client, sub_tree=file_or_dir['contents'])
-    
+        with ContextThreadPoolExecutor(max_workers=self.listing_concurrency) as executor:
+            for depth, level in enumerate(levels[1:], start=1):
+                missing = [dir_path for dir_path in level if dir_path not in existing]
+                list(executor.map(create_directory, missing))
+                logging.info(f"Created {len(missing)} of {len(level)} directories at depth {depth} of production '{production_name}'")
 
     def get_wip_production_tree(self, production_name):
         # return a tree of the production wip directory 
         return [({'name':production_name, 'type':'directory', 'contents':self.get_wip_directory(production_name)})]
 
     def get_wip_directory(self, path=""):
-        from azure.core.exceptions import ResourceNotFoundError 
-        try:
-            file_dir_list = list(self.share_client.list_directories_and_files(directory_name=path))
-        except azure.core.exceptions.ResourceNotFoundError as e:
-            logging.error(f"Directory does not exist '{self.share_client.share_name}/{directory_name}', error: '{e}'")
-        name = path.split('/')[-1]
-
+        # return the tree under path, walking the share one level at a time and listing every directory in a level in parallel
         tree = []
+        # the tree contents list that the listing of each directory is added to
+        contents_by_path = {path: tree}
+        for dir_path, file_dir_list in self.walk_wip_directory(path):
+            for sub_dir_path, sub_contents in self.add_wip_listing(dir_path, contents_by_path.pop(dir_path), file_dir_list):
+                contents_by_path[sub_dir_path] = sub_contents
+        return tree
 
-        for file_or_dir in file_dir_list:
-            name = file_or_dir['name']
-            if not file_or_dir['is_directory']:
-                tree.append({'name':name, 'type':'file'})
-            else:
-                if path != "":
-                    dir_path = f"{path}/{name}"
+    def walk_wip_directory(self, path="", include=None, missing_ok=False):
+        from azure.core.exceptions import ResourceNotFoundError
+        # yield (directory path, listing) for path and every directory under it, listing all the directories in a level in parallel
+        # with missing_ok nothing is yielded when path itself doesn't exist, e.g. a production removed from the share when taken offline
+
+        def list_directory(dir_path):
+            try:
+                if include:
+                    return list(self.share_client.list_directories_and_files(directory_name=dir_path, include=include))
+                return list(self.share_client.list_directories_and_files(directory_name=dir_path))
+            except ResourceNotFoundError as e:
+                if missing_ok and dir_path == path:
+                    logging.info(f"Directory '{self.share_client.share_name}/{dir_path}' isn't on the share")
+                    return None
+                logging.error(f"Directory does not exist '{self.share_client.share_name}/{dir_path}', error: '{e}'")
+                raise e
+
+        level = [path]
+        with ContextThreadPoolExecutor(max_workers=self.listing_concurrency) as executor:
+            while level:
+                next_level = []
+                for dir_path, file_dir_list in zip(level, executor.map(list_directory, level)):
+                    if file_dir_list is None:
+                        continue
+                    yield dir_path, file_dir_list
+                    for file_or_dir in file_dir_list:
+                        if file_or_dir['is_directory']:
+                            next_level.append(f"{dir_path}/{file_or_dir['name']}" if dir_path != "" else file_or_dir['name'])
+                logging.info(f"Listed {len(level)} directories under '{path}'")
+                level = next_level
+
+    ## sync operations
+
+    def list_wip_files(self, production_name, listings=None, missing_ok=False):
+        # return {path within the production: FileProperties} for every file in the production WIP directory that is archived, files in
+        # the ingest folder are left out, they would otherwise be copied to the ingest prefix and ingested again. listings, when given, is
+        # filled in with the listing of every directory so refresh_production_tree can use the same walk of the share. with missing_ok a
+        # production directory that isn't on the share has no files
+        wip_files = {}
+        for dir_path, file_dir_list in self.walk_wip_directory(production_name, include=['timestamps'], missing_ok=missing_ok):
+            if listings is not None:
+                listings[dir_path] = file_dir_list
+            for file_or_dir in file_dir_list:
+                path = f"{dir_path}/{file_or_dir['name']}"[len(production_name) + 1:]
+                if not file_or_dir['is_directory'] and self.is_archived_file(path):
+                    wip_files[path] = file_or_dir
+        return wip_files
+
+    def list_production_blobs(self, production_name):
+        # return {path within the production: BlobProperties} for every archived file, leaving out the metadata blob and the ingest prefix
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        prefix = f"{production_name}/"
+        production_blobs = {}
+        for blob in container_client.list_blobs(name_starts_with=prefix, include=['metadata']):
+            path = blob.name[len(prefix):]
+            if self.is_archived_file(path):
+                production_blobs[path] = blob
+        return production_blobs
+
+    def is_archived_file(self, path):
+        # true for a path within a production that is an archived file, rather than the metadata, journal or checkpoint blobs or an upload
+        if path in (self.metadata_file_name, f"{self.metadata_file_name}.journal", f"{self.metadata_file_name}.ingest", f"{self.metadata_file_name}.transfers"):
+            return False
+        return not path.startswith(f"{self.ingest_prefix}/")
+
+    def sync_url(self, base_url, path):
+        from urllib.parse import quote
+        # add a path within the production to a SAS url for the production, so every file shares one signed token
+        url, sas_token = base_url.split('?', 1)
+        return f"{url}/{quote(path)}?{sas_token}"
+
+    def plan_production_to_blob(self, production_name, delete=True, listings=None, content_index=None):
+        # compare the WIP files with the archived blobs, return the operations that make the blobs match the WIP directory
+        # a file is unchanged when its size and the last modified time stored on the blob at copy time match, when only the time differs
+        # the content MD5 of the file and blob are compared so that touched but unchanged files only have their blob metadata updated
+        # copies and deletes of an archived file carry its MD5 as archived_md5, so the content index is only changed for what it holds.
+        # content_index, when given, is filled in with the index read to find duplicates, for index_sync_operations to update
+        # a production taken offline may have had its directory removed from the share, it then has nothing to copy or delete
+        online_paths = self.get_production_online_paths(production_name)
+        wip_files = self.list_wip_files(production_name, listings=listings, missing_ok=online_paths == [])
+        production_blobs = self.list_production_blobs(production_name)
+
+        operations = []
+        touched = []
+        for path, wip_file in wip_files.items():
+            last_modified = str(wip_file.get('last_modified'))
+            blob = production_blobs.get(path)
+            if blob is None:
+                operations.append({'operation':'copy', 'path':path, 'bytes':wip_file['size'], 'last_modified':last_modified})
+            elif blob.size != wip_file['size']:
+                operations.append({'operation':'copy', 'path':path, 'bytes':wip_file['size'], 'last_modified':last_modified,
+                                   'archived_md5':self.md5_string(blob.content_settings.content_md5)})
+            elif (blob.metadata or {}).get('wip_last_modified') != last_modified:
+                touched.append(path)
+
+        def get_md5(path):
+            file_client = self.share_client.get_file_client(f"{production_name}/{path}")
+            return file_client.get_file_properties().content_settings.content_md5
+
+        with ContextThreadPoolExecutor(max_workers=self.copy_concurrency) as executor:
+            for path, file_md5 in zip(touched, executor.map(get_md5, touched)):
+                last_modified = str(wip_files[path].get('last_modified'))
+                blob = production_blobs[path]
+                if file_md5 and file_md5 == blob.content_settings.content_md5:
+                    operations.append({'operation':'update_metadata', 'path':path, 'bytes':0, 'last_modified':last_modified})
                 else:
-                    dir_path = name
-                tree.append({'name':name, 'type':'directory', 'contents':self.get_wip_directory(dir_path)})
-        return tree
+                    operations.append({'operation':'copy', 'path':path, 'bytes':wip_files[path]['size'], 'last_modified':last_modified, 'md5':self.md5_string(file_md5),
+                                       'archived_md5':self.md5_string(blob.content_settings.content_md5)})
 
-    def get_files_sas_url(self, production_name=None, path=None):
-        from datetime import datetime, timedelta
-        from azure.storage.blob import generate_container_sas
-        from azure.storage.fileshare import ShareServiceClient, generate_account_sas, ResourceTypes, AccountSasPermissions
+        if delete:
+            # a production only partly online only has its online paths on the share, and one taken offline may have none, archived
+            # files that aren't on the share are only deleted where the share holds the whole of that part of the production. files in
+            # the Archive tier can't have been restored yet, so their absence from the share doesn't mean they were deleted
+            for path, blob in production_blobs.items():
+                if path not in wip_files and blob.blob_tier != 'Archive' and (online_paths is None or self.in_paths(path, online_paths)):
+                    operations.append({'operation':'delete', 'path':path, 'bytes':0, 'archived_md5':self.md5_string(blob.content_settings.content_md5)})
 
-        sas_token = generate_account_sas(
-            account_name=self.share_client.account_name,
-            account_key=self.share_client.credential.account_key,
-            resource_types=ResourceTypes(service=True, container=True, object=True),
-            protocol='https',
-            permission=AccountSasPermissions(read=True, write=True, delete=True, list=True, add=True, create=True, update=True, process=True, delete_previous_version=False),
-            expiry=datetime.utcnow() + timedelta(hours=1)
+            # renamed files and folders are moved within the archive rather than copied again
+            operations = self.detect_moves(production_name, operations, wip_files, production_blobs)
+            for operation in operations:
+                if operation['operation'] == 'move':
+                    operation['md5'] = self.md5_string(production_blobs[operation['source']].content_settings.content_md5)
+
+        # files whose content is already archived, in this or another production, are copied from that blob
+        if self.content_index:
+            self.find_duplicates(production_name, operations, content_index=content_index)
+
+        return self.sync_report(production_name, operations, unchanged=len(wip_files) - sum(1 for o in operations if o['operation'] != 'delete'))
+
+    def detect_moves(self, production_name, operations, wip_files, production_blobs):
+        # replace the copy of a new file and the delete of its old blob with a server side move when a file or whole folder was renamed
+        # folders are matched first by fingerprint, the sizes and paths of every file under them, then single files by name and size
+        # every match is confirmed before it becomes a move, by the content MD5 of the WIP file and the archived blob when both have one
+        # and otherwise by the file's last modified time matching the one stored on the blob
+        copies = {o['path']: o for o in operations if o['operation'] == 'copy' and o['path'] not in production_blobs}
+        # archived blobs can't be copied from until they are rehydrated, they are deleted and the file copied again
+        deletes = {o['path']: o for o in operations if o['operation'] == 'delete' and production_blobs[o['path']].blob_tier != 'Archive'}
+        if not copies or not deletes:
+            return operations
+
+        def folder_fingerprints(paths, sizes):
+            # fingerprint every folder whose files are all in paths, a folder that still has some of its files isn't a move
+            files_under = {}
+            for path in sizes:
+                parts = path.split('/')
+                for i in range(1, len(parts)):
+                    files_under.setdefault('/'.join(parts[:i]), []).append(path)
+            fingerprints = {}
+            for folder, folder_paths in files_under.items():
+                if all(p in paths for p in folder_paths):
+                    fingerprints[folder] = frozenset((p[len(folder) + 1:], sizes[p]) for p in folder_paths)
+            return fingerprints
+
+        wip_sizes = {path: wip_file['size'] for path, wip_file in wip_files.items()}
+        blob_sizes = {path: blob.size for path, blob in production_blobs.items()}
+        new_folders = {}
+        for folder, fingerprint in folder_fingerprints(copies, wip_sizes).items():
+            new_folders.setdefault(fingerprint, []).append(folder)
+
+        # candidate moves as {new path: old path}, shallowest folders first so a renamed parent is matched before its children
+        candidates = {}
+        for old_folder, fingerprint in sorted(folder_fingerprints(deletes, blob_sizes).items(), key=lambda f: f[0].count('/')):
+            for new_folder in new_folders.get(fingerprint, []):
+                pairs = {f"{new_folder}/{name}": f"{old_folder}/{name}" for name, size in fingerprint}
+                if not any(new_path in candidates for new_path in pairs) and not set(pairs.values()) & set(candidates.values()):
+                    logging.info(f"folder '{old_folder}' looks to have moved to '{new_folder}'")
+                    candidates.update(pairs)
+                    break
+
+        # single files, only when the name and size match exactly one deleted blob and exactly one new file, a blob can only be moved once
+        # so when it was copied to several places the others stay copies
+        deleted_by_name = {}
+        for old_path in deletes:
+            if old_path not in candidates.values():
+                deleted_by_name.setdefault((old_path.split('/')[-1], blob_sizes[old_path]), []).append(old_path)
+        new_by_name = {}
+        for new_path in copies:
+            if new_path not in candidates:
+                new_by_name.setdefault((new_path.split('/')[-1], wip_sizes[new_path]), []).append(new_path)
+        for key, new_paths in new_by_name.items():
+            matches = deleted_by_name.pop(key, [])
+            if len(new_paths) == 1 and len(matches) == 1:
+                candidates[new_paths[0]] = matches[0]
+
+        def confirm(new_path):
+            blob = production_blobs[candidates[new_path]]
+            if blob.content_settings.content_md5:
+                file_client = self.share_client.get_file_client(f"{production_name}/{new_path}")
+                file_md5 = file_client.get_file_properties().content_settings.content_md5
+                if file_md5:
+                    return file_md5 == blob.content_settings.content_md5
+            # files written over SMB have no MD5, a rename keeps the file's last modified time, which was stored on the blob when it was
+            # archived. a file renamed by something that also set its last modified time isn't confirmed and is copied again
+            return (blob.metadata or {}).get('wip_last_modified') == str(wip_files[new_path].get('last_modified'))
+
+        with ContextThreadPoolExecutor(max_workers=self.listing_concurrency) as executor:
+            confirmed = {new_path for new_path, is_move in zip(candidates, executor.map(confirm, candidates)) if is_move}
+        if len(confirmed) < len(candidates):
+            logging.info(f"{len(candidates) - len(confirmed)} of {len(candidates)} possible moves in production '{production_name}' weren't confirmed, they are copied")
+
+        moved_from = {candidates[new_path] for new_path in confirmed}
+        operations = [o for o in operations if o['path'] not in confirmed or o['operation'] != 'copy']
+        operations = [o for o in operations if o['path'] not in moved_from or o['operation'] != 'delete']
+        for new_path in confirmed:
+            copy = copies[new_path]
+            operations.append({'operation':'move', 'path':new_path, 'source':candidates[new_path], 'bytes':0, 'moved_bytes':copy['bytes'], 'last_modified':copy['last_modified']})
+        return operations
+
+    def plan_production_to_files(self, production_name, checkpoint=None, paths=None):
+        # compare the archived blobs with the WIP files, return the copies that restore missing or different sized files
+        # files on the share that aren't in the archive are never deleted, they may be new work
+        # a large file part way through a chunked transfer is already its full size on the share, the checkpoint says it still needs copying
+        # with paths only the files at or under those paths are restored. files in the Archive tier need rehydrating before they can be
+        # copied, they are planned as rehydrate operations (pending when rehydration has already been asked for)
+        wip_files = self.list_wip_files(production_name)
+        production_blobs = self.list_production_blobs(production_name)
+        if paths is not None:
+            production_blobs = {path: blob for path, blob in production_blobs.items() if self.in_paths(path, paths)}
+        unfinished = set()
+        if any(blob.size >= self.transfer_threshold for blob in production_blobs.values()):
+            unfinished = (checkpoint or self.transfer_checkpoint(production_name)).pending("files/")
+
+        operations = []
+        for path, blob in production_blobs.items():
+            wip_file = wip_files.get(path)
+            if wip_file is not None and wip_file['size'] == blob.size and path not in unfinished:
+                continue
+            if blob.blob_tier == 'Archive':
+                operations.append({'operation':'rehydrate', 'path':path, 'bytes':0, 'pending':bool(blob.archive_status)})
+            else:
+                operations.append({'operation':'copy', 'path':path, 'bytes':blob.size, 'etag':blob.etag})
+
+        return self.sync_report(production_name, operations, unchanged=len(production_blobs) - len(operations))
+
+    def sync_report(self, production_name, operations, unchanged):
+        # summarise a list of planned operations, the same report is returned from a dry run and once the operations have run
+        report = {'production_name':production_name, 'operations':operations, 'unchanged_count':unchanged, 'bytes':sum(o['bytes'] for o in operations), 'moved_bytes':sum(o.get('moved_bytes', 0) for o in operations),
+                  'duplicate_count':sum(1 for o in operations if o.get('duplicate_of')), 'duplicate_bytes':sum(o['bytes'] for o in operations if o.get('duplicate_of'))}
+        for operation in ('copy', 'update_metadata', 'move', 'delete', 'rehydrate'):
+            report[f"{operation}_count"] = sum(1 for o in operations if o['operation'] == operation)
+        return report
+
+    def wait_for_copy(self, client, get_properties):
+        import time
+        # poll a server side copy until it is no longer pending, raise if it didn't succeed
+        properties = get_properties()
+        while properties.copy.status == 'pending':
+            time.sleep(1)
+            properties = get_properties()
+        if properties.copy.status != 'success':
+            raise RuntimeError(f"copy to '{client.url}' finished with status '{properties.copy.status}': {properties.copy.status_description}")
+        return properties
+
+    def run_sync_operations(self, operations, run_operation):
+        # run each planned operation on a pool of copy_concurrency workers, return the operations that failed
+        failed = []
+
+        def run(operation):
+            try:
+                run_operation(operation)
+                logging.info(f"{operation['operation']} '{operation['path']}' done")
+            except Exception as e:
+                logging.error(f"{operation['operation']} '{operation['path']}' failed: '{e}'")
+                operation['error'] = str(e)
+                failed.append(operation)
+
+        with ContextThreadPoolExecutor(max_workers=self.copy_concurrency) as executor:
+            list(executor.map(run, operations))
+        return failed
+
+    def sync_production_to_blob(self, production_name, delete=True, dry_run=False, listings=None):
+        # copy new and changed WIP files to the archive server side and delete archived files that were removed from the WIP directory
+        content_index = {}
+        report = self.plan_production_to_blob(production_name, delete=delete, listings=listings, content_index=content_index)
+        report['dry_run'] = dry_run
+        logging.info(f"sync '{production_name}' to blob: {report['copy_count']} copies ({report['bytes']} bytes), {report['update_metadata_count']} metadata updates, {report['move_count']} moves ({report['moved_bytes']} bytes), {report['delete_count']} deletes, {report['unchanged_count']} unchanged")
+        if dry_run:
+            return report
+
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        # the URLs copies are made from only need to read
+        files_url = self.get_files_sas_url(production_name=production_name, permission="r")
+        blob_url = self.get_blob_sas_url(production_name=production_name, permission="r")
+        checkpoint = self.transfer_checkpoint(production_name)
+
+        def run_operation(operation):
+            blob_client = container_client.get_blob_client(f"{production_name}/{operation['path']}")
+            if operation['operation'] == 'copy' and operation.get('duplicate_of') and self.copy_duplicate(blob_client, operation):
+                pass
+            elif operation['operation'] == 'copy' and operation['bytes'] >= self.transfer_threshold:
+                operation['transfer'] = self.transfer_file_to_blob(production_name, operation['path'], operation['last_modified'], checkpoint, files_url)
+                operation['md5'] = operation['transfer'].pop('md5')
+            elif operation['operation'] == 'copy':
+                blob_client.start_copy_from_url(self.sync_url(files_url, operation['path']), metadata={'wip_last_modified':operation['last_modified']})
+                properties = self.wait_for_copy(blob_client, blob_client.get_blob_properties)
+                operation['md5'] = self.md5_string(properties.content_settings.content_md5)
+            elif operation['operation'] == 'update_metadata':
+                blob_client.set_blob_metadata(metadata={'wip_last_modified':operation['last_modified']})
+            elif operation['operation'] == 'move':
+                # blob to blob copy within the account, then remove the old name
+                blob_client.start_copy_from_url(self.sync_url(blob_url, operation['source']), metadata={'wip_last_modified':operation['last_modified']})
+                self.wait_for_copy(blob_client, blob_client.get_blob_properties)
+                container_client.get_blob_client(f"{production_name}/{operation['source']}").delete_blob()
+            elif operation['operation'] == 'delete':
+                blob_client.delete_blob()
+
+        report['failed'] = self.run_sync_operations(report['operations'], run_operation)
+        checkpoint.save(force=True)
+        if self.content_index:
+            self.index_sync_operations(production_name, report['operations'], content_index=content_index)
+            # duplicates whose blob no longer matched were copied from the share
+            report['duplicate_count'] = sum(1 for o in report['operations'] if o.get('duplicate_of'))
+            report['duplicate_bytes'] = sum(o['bytes'] for o in report['operations'] if o.get('duplicate_of'))
+        return report
+
+    def sync_production_to_files(self, production_name, dry_run=False, paths=None, rehydrate_priority="Standard"):
+        # copy archived files that are missing or different on the WIP directory back to the share server side, only those at or under
+        # paths when given. rehydration of archived files is started in bulk, they are copied by a later sync once they are back online
+        checkpoint = self.transfer_checkpoint(production_name)
+        report = self.plan_production_to_files(production_name, checkpoint=checkpoint, paths=paths)
+        report['dry_run'] = dry_run
+        logging.info(f"sync '{production_name}' to files: {report['copy_count']} copies ({report['bytes']} bytes), {report['rehydrate_count']} archived, {report['unchanged_count']} unchanged")
+        if dry_run:
+            return report
+
+        rehydrate = [o['path'] for o in report['operations'] if o['operation'] == 'rehydrate' and not o['pending']]
+        if rehydrate:
+            report['rehydrate_failed'] = self.set_production_blob_tiers(production_name, rehydrate, "Hot", rehydrate_priority=rehydrate_priority)
+            self.update_production_metadata(production_name, {'rehydrate_requested':self.utc_timestamp()})
+
+        blob_url = self.get_blob_sas_url(production_name=production_name, permission="r")
+
+        def run_operation(operation):
+            if operation['bytes'] >= self.transfer_threshold:
+                operation['transfer'] = self.transfer_blob_to_file(production_name, operation['path'], checkpoint, blob_url)
+                return
+            file_client = self.share_client.get_file_client(f"{production_name}/{operation['path']}")
+            file_client.start_copy_from_url(self.sync_url(blob_url, operation['path']))
+            properties = self.wait_for_copy(file_client, file_client.get_file_properties)
+            self.set_restored_last_modified(production_name, operation['path'], properties.last_modified, operation['etag'])
+
+        report['failed'] = self.run_sync_operations([o for o in report['operations'] if o['operation'] == 'copy'], run_operation)
+        checkpoint.save(force=True)
+        return report
+
+    ## large file transfers
+
+    def transfer_checkpoint(self, production_name):
+        # checkpoint manifest for the chunked transfers of a production, nothing is read until a large file is copied
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        return TransferCheckpoint(container_client.get_blob_client(f"{production_name}/{self.metadata_file_name}.transfers"), self.transfer_checkpoint_interval)
+
+    def block_id(self, offset, length):
+        # fixed width, every block ID of a blob must be the same length
+        return f"{offset:015d}-{length:011d}"
+
+    def transfer_chunks(self, size, chunks_done, copy_chunk, chunk_done, chunk_size, min_chunk_size, max_chunk_size):
+        import time
+        from concurrent.futures import wait, FIRST_COMPLETED
+        from azure.core.exceptions import HttpResponseError
+        # copy the bytes of a file not covered by chunks_done with copy_chunk(offset, length), calling chunk_done(offset, length) as each one
+        # completes. chunks are cut from the gaps as they are scheduled so they follow the tuner's chunk size, resumed chunks may be another size.
+        # a chunk storage still throttles after the SDK's retries is backed off and tried again, up to batch_retries times
+        # return the chunk size and concurrency the transfer settled on
+        tuner = TransferTuner(chunk_size, min_chunk_size, max_chunk_size, self.transfer_concurrency, self.transfer_max_concurrency)
+        gaps = []
+        position = 0
+        for offset, length in sorted(chunks_done):
+            if offset > position:
+                gaps.append([position, offset])
+            position = max(position, offset + length)
+        if position < size:
+            gaps.append([position, size])
+        retries = []
+
+        def next_chunk():
+            if retries:
+                return retries.pop()
+            if not gaps:
+                return None
+            start, end = gaps[0]
+            length = min(tuner.chunk_size, end - start)
+            if start + length == end:
+                gaps.pop(0)
+            else:
+                gaps[0][0] = start + length
+            return (start, length, 1)
+
+        def run(offset, length):
+            start = time.perf_counter()
+            copy_chunk(offset, length)
+            return time.perf_counter() - start
+
+        pending = {}
+        with ContextThreadPoolExecutor(max_workers=self.transfer_max_concurrency) as executor:
+            while True:
+                while len(pending) < tuner.concurrency:
+                    chunk = next_chunk()
+                    if chunk is None:
+                        break
+                    pending[executor.submit(run, chunk[0], chunk[1])] = chunk
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    offset, length, attempt = pending.pop(future)
+                    try:
+                        seconds = future.result()
+                    except HttpResponseError as e:
+                        if e.status_code not in (429, 503) or attempt > self.batch_retries:
+                            raise e
+                        logging.warning(f"storage throttled chunk at {offset} with status {e.status_code}, retrying (attempt {attempt} of {self.batch_retries})")
+                        tuner.throttled()
+                        time.sleep(min(self.batch_backoff * 2 ** (attempt - 1), 60))
+                        retries.append((offset, length, attempt + 1))
+                        continue
+                    chunk_done(offset, length)
+                    tuner.chunk_done(length, seconds)
+        return {'chunk_size':tuner.chunk_size, 'concurrency':tuner.concurrency}
+
+    def transfer_file_to_blob(self, production_name, path, last_modified, checkpoint, files_url):
+        from azure.core.exceptions import ResourceNotFoundError
+        from azure.storage.blob import BlobBlock, ContentSettings
+        # copy a large WIP file to the archive as blocks staged from the file URL in parallel, then committed in one go. the archived blob is
+        # untouched until the commit, and storage keeps staged blocks for a week, so an interrupted copy resumes from the blocks it staged
+        file_client = self.share_client.get_file_client(f"{production_name}/{path}")
+        blob_client = self.blob_service_client.get_container_client(str(self.production_store_id)).get_blob_client(f"{production_name}/{path}")
+        source = file_client.get_file_properties()
+        source_url = self.sync_url(files_url, path)
+        key = f"blob/{path}"
+
+        chunks_done = checkpoint.start(key, source.etag, source.size)
+        if chunks_done:
+            # only resume the blocks storage still holds
+            try:
+                staged = {block.id for block in blob_client.get_block_list('uncommitted')[1]}
+            except ResourceNotFoundError:
+                staged = set()
+            chunks_done = [chunk for chunk in chunks_done if self.block_id(*chunk) in staged]
+            checkpoint.set_chunks(key, chunks_done)
+            logging.info(f"resuming copy of '{path}' to blob with {len(chunks_done)} blocks staged")
+
+        # a block blob holds at most 50,000 blocks
+        min_block_size = max(4 * 1024 * 1024, -(-source.size // 50000))
+        transfer = self.transfer_chunks(
+            source.size,
+            chunks_done,
+            lambda offset, length: blob_client.stage_block_from_url(self.block_id(offset, length), source_url, source_offset=offset, source_length=length),
+            lambda offset, length: checkpoint.chunk_done(key, offset, length),
+            self.transfer_block_size,
+            min_block_size,
+            max(self.transfer_max_block_size, min_block_size),
         )
-        if production_name and path:
-            return f"https://{self.share_client.account_name}.file.core.windows.net/{self.production_store_name}/{production_name}/{path}?{sas_token}"
-        elif production_name and not path:
-            return f"https://{self.share_client.account_name}.file.core.windows.net/{self.production_store_name}/{production_name}?{sas_token}"
-        elif path and not production_name:
-            logging.error("must pass 'production name' parameter wwith 'path' parameter")
-        else:
-            return f"https://{self.share_client.account_name}.file.core.windows.net/{self.production_store_name}?{sas_token}"
 
+        if file_client.get_file_properties().etag != source.etag:
+            checkpoint.finish(key)
+            raise RuntimeError(f"'{path}' changed during the copy to blob")
+        blocks = [BlobBlock(block_id=self.block_id(*chunk)) for chunk in sorted(checkpoint.chunks(key))]
+        # the file's content MD5 is carried over so change and move detection can compare it
+        content_settings = ContentSettings(content_type=source.content_settings.content_type, content_md5=source.content_settings.content_md5)
+        blob_client.commit_block_list(blocks, content_settings=content_settings, metadata={'wip_last_modified':last_modified})
+        checkpoint.finish(key)
+        logging.info(f"copied '{path}' ({source.size} bytes) to blob in {len(blocks)} blocks")
+        transfer['md5'] = self.md5_string(source.content_settings.content_md5)
+        return transfer
 
-        ## sync operations
+    def transfer_blob_to_file(self, production_name, path, checkpoint, blob_url):
+        from azure.core.exceptions import ResourceNotFoundError
+        from azure.storage.fileshare import ContentSettings
+        # copy a large archived file to the WIP share as ranges written from the blob URL in parallel, put range from URL takes at most 4MiB.
+        # an interrupted copy resumes from the ranges written as long as the file on the share is still the size it was created at
+        file_client = self.share_client.get_file_client(f"{production_name}/{path}")
+        blob_client = self.blob_service_client.get_container_client(str(self.production_store_id)).get_blob_client(f"{production_name}/{path}")
+        source = blob_client.get_blob_properties()
+        source_url = self.sync_url(blob_url, path)
+        key = f"files/{path}"
 
-    def azcopy_copy(self, source, dest):
-        import subprocess
-        command_exec = "/usr/local/bin/azcopy"
-        command_params = [command_exec, "copy", source, dest, "--recursive", "--s2s-detect-source-changed"]
-        print(f"Tyring: {' '.join(command_params)}")
-        process_return = subprocess.run(command_params)
-        print(process_return)
+        chunks_done = checkpoint.start(key, source.etag, source.size)
+        if chunks_done:
+            try:
+                if file_client.get_file_properties().size != source.size:
+                    chunks_done = []
+            except ResourceNotFoundError:
+                chunks_done = []
+            checkpoint.set_chunks(key, chunks_done)
+            logging.info(f"resuming copy of '{path}' to files with {len(chunks_done)} ranges written")
+        if not chunks_done:
+            content_settings = ContentSettings(content_type=source.content_settings.content_type, content_md5=source.content_settings.content_md5)
+            file_client.create_file(size=source.size, content_settings=content_settings)
 
-    def azcopy_sync(self, source, dest):
-        # don't use yet, sync files <=> blob not supported in azcopy v10
-        import subprocess
-        command_exec = "/usr/local/bin/azcopy"
-        command_params = [command_exec, "sync", source, dest, "--recursive"]
-        print(f"Tyring: {' '.join(command_params)}")
-        process_return = subprocess.run(command_params)
-        print(process_return)
+        transfer = self.transfer_chunks(
+            source.size,
+            chunks_done,
+            lambda offset, length: file_client.upload_range_from_url(source_url, offset=offset, length=length, source_offset=offset),
+            lambda offset, length: checkpoint.chunk_done(key, offset, length),
+            4 * 1024 * 1024,
+            1024 * 1024,
+            4 * 1024 * 1024,
+        )
 
+        if blob_client.get_blob_properties().etag != source.etag:
+            checkpoint.finish(key)
+            raise RuntimeError(f"'{path}' changed during the copy to files")
+        checkpoint.finish(key)
+        self.set_restored_last_modified(production_name, path, file_client.get_file_properties().last_modified, source.etag)
+        logging.info(f"copied '{path}' ({source.size} bytes) to files")
+        return transfer
 
-        # sync new ingests to files
+    def set_restored_last_modified(self, production_name, path, last_modified, etag):
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceModifiedError
+        # a file restored to the share has a new last modified time, store it on the blob it was copied from so the next sync to blob sees
+        # the file as unchanged rather than copying it again. only when the blob is still the one copied, etag as planned
+        blob_client = self.blob_service_client.get_container_client(str(self.production_store_id)).get_blob_client(f"{production_name}/{path}")
+        try:
+            blob_client.set_blob_metadata(metadata={'wip_last_modified':str(last_modified)}, etag=etag, match_condition=MatchConditions.IfNotModified)
+        except ResourceModifiedError:
+            logging.info(f"'{path}' was archived again while it was restored, the next sync to blob compares it")
 
-        # sync files to blob
-    
-    def copy_production_to_blob(self, production_name=None):
-        # copy produciton storage on files to blob
+    ## sync new ingests to files
+
+    def ingest_checkpoint_blob_name(self, production_name):
+        # blob holding the progress of files part way through ingest, so an interrupted ingest resumes rather than starting again
+        return f"{production_name}/{self.metadata_file_name}.ingest"
+
+    def get_ingest_checkpoint(self, production_name):
+        import json
+        from azure.core.exceptions import ResourceNotFoundError
+        # return {'files': {path: progress of a file part way through}, 'ingested': {path: etag of an upload ingested and kept}}
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        try:
+            checkpoint = json.loads(container_client.get_blob_client(self.ingest_checkpoint_blob_name(production_name)).download_blob().readall().decode("utf-8"))
+        except ResourceNotFoundError:
+            checkpoint = {'files':{}}
+        checkpoint.setdefault('ingested', {})
+        return checkpoint
+
+    def set_ingest_checkpoint(self, production_name, checkpoint):
+        import json
+        from azure.core.exceptions import ResourceNotFoundError
+        # write the checkpoint, or delete its blob once there is nothing part way through or kept to remember
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        if checkpoint['files'] or checkpoint.get('ingested'):
+            container_client.upload_blob(name=self.ingest_checkpoint_blob_name(production_name), data=json.dumps(checkpoint), overwrite=True)
+            return
+        try:
+            container_client.get_blob_client(self.ingest_checkpoint_blob_name(production_name)).delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+    def ingest_production(self, production_name, delete_ingested=True):
+        import time
+        import threading
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.fileshare import ContentSettings
+        # move files uploaded to the production's ingest prefix into the same path on the WIP share. each file is copied server side in
+        # ingest_range_size ranges with put range from URL, so no file data passes through (or is held in) this process. ingest_file_concurrency
+        # files and ingest_range_concurrency ranges per file run at once. ingested blobs are deleted so they are never listed again, or with
+        # delete_ingested=False kept and recorded by etag in the checkpoint so they are only ingested again once re-uploaded. the ranges done
+        # of files part way through are checkpointed so an interrupted ingest picks up where it left off
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        prefix = f"{production_name}/{self.ingest_prefix}/"
+        blob_url = self.get_blob_sas_url(production_name=production_name, permission="r")
+        checkpoint = self.get_ingest_checkpoint(production_name)
+        checkpoint_lock = threading.Lock()
+        checkpoint_saved = [time.monotonic()]
+        created_directories = set()
+        report = {'production_name':production_name, 'files':0, 'bytes':0, 'resumed':0, 'skipped':0, 'duplicates':0, 'duplicate_bytes':0, 'failed':[]}
+        # paths of every upload listed, so uploads that have since been deleted are dropped from the checkpoint
+        listed = set()
+        # sizes and MD5s of the contents already archived in the store, read on the first upload that carries an MD5
+        content_index = []
+
+        def save_checkpoint(force=False):
+            # written at most every ingest_checkpoint_interval seconds while ranges complete, and whenever a file starts or finishes
+            with checkpoint_lock:
+                if force or time.monotonic() - checkpoint_saved[0] >= self.ingest_checkpoint_interval:
+                    self.set_ingest_checkpoint(production_name, checkpoint)
+                    checkpoint_saved[0] = time.monotonic()
+
+        def create_parent_directories(path):
+            parts = path.split('/')[:-1]
+            for i in range(1, len(parts) + 1):
+                dir_path = '/'.join(parts[:i])
+                if dir_path in created_directories:
+                    continue
+                try:
+                    self.share_client.create_directory(directory_name=dir_path)
+                except ResourceExistsError:
+                    pass
+                created_directories.add(dir_path)
+
+        def ingest_file(blob):
+            path = blob.name[len(production_name) + 1:]
+            source_url = self.sync_url(blob_url, path)
+            file_client = self.share_client.get_file_client(f"{production_name}/{path}")
+            with checkpoint_lock:
+                listed.add(path)
+                already_ingested = checkpoint['ingested'].get(path) == blob.etag
+            if already_ingested:
+                # kept from an earlier ingest and not uploaded again since, only removed when ingested uploads are being deleted
+                if delete_ingested:
+                    container_client.get_blob_client(blob.name).delete_blob(etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+                    with checkpoint_lock:
+                        checkpoint['ingested'].pop(path, None)
+                    save_checkpoint(force=True)
+                with checkpoint_lock:
+                    report['skipped'] += 1
+                return
+            with checkpoint_lock:
+                progress = checkpoint['files'].get(path)
+                if progress and progress['etag'] == blob.etag and progress['size'] == blob.size and progress['range_size'] == self.ingest_range_size:
+                    report['resumed'] += 1
+                    ranges_done = set(progress['ranges_done'])
+                else:
+                    # new file, or the upload or range size changed since the checkpoint
+                    progress = checkpoint['files'][path] = {'etag':blob.etag, 'size':blob.size, 'range_size':self.ingest_range_size, 'ranges_done':[]}
+                    ranges_done = set()
+            if not ranges_done:
+                create_parent_directories(f"{production_name}/{path}")
+                # the upload's MD5 is kept on the file so it is carried into the archive and the content index when the file is archived
+                file_client.create_file(size=blob.size, content_settings=ContentSettings(content_type=blob.content_settings.content_type, content_md5=blob.content_settings.content_md5))
+                save_checkpoint(force=True)
+
+            def copy_range(offset):
+                length = min(self.ingest_range_size, blob.size - offset)
+                file_client.upload_range_from_url(source_url, offset=offset, length=length, source_offset=offset)
+                with checkpoint_lock:
+                    progress['ranges_done'].append(offset)
+                save_checkpoint()
+
+            offsets = [offset for offset in range(0, blob.size, self.ingest_range_size) if offset not in ranges_done]
+            with ContextThreadPoolExecutor(max_workers=self.ingest_range_concurrency) as range_executor:
+                list(range_executor.map(copy_range, offsets))
+
+            if delete_ingested:
+                container_client.get_blob_client(blob.name).delete_blob(etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+            key = self.content_key(blob.size, blob.content_settings.content_md5)
+            with checkpoint_lock:
+                del checkpoint['files'][path]
+                if delete_ingested:
+                    checkpoint['ingested'].pop(path, None)
+                else:
+                    checkpoint['ingested'][path] = blob.etag
+                report['files'] += 1
+                report['bytes'] += blob.size
+                if self.content_index and key and blob.size >= self.dedup_min_size:
+                    if not content_index:
+                        content_index.append(self.get_content_index()[0])
+                    if key in content_index[0]:
+                        # the archive already holds this content, it is copied from the existing blob when the file is archived
+                        report['duplicates'] += 1
+                        report['duplicate_bytes'] += blob.size
+            save_checkpoint(force=True)
+            logging.info(f"ingested '{path}' ({blob.size} bytes) into production '{production_name}'")
 
-        # copy the files:
-        # get blob SAS url
-        blob_url = self.get_blob_sas_url(production_name=production_name)
+        def run(blob):
+            try:
+                ingest_file(blob)
+            except Exception as e:
+                logging.error(f"ingest of '{blob.name}' failed: '{e}'")
+                report['failed'].append({'path':blob.name[len(production_name) + 1:], 'error':str(e)})
 
-        # get files SAS url
-        files_url = self.get_files_sas_url(production_name=production_name, path="*")
+        # only a window of listed blobs is held at a time, the pool works through each window before more are listed
+        with ContextThreadPoolExecutor(max_workers=self.ingest_file_concurrency) as executor:
+            for page in container_client.list_blobs(name_starts_with=prefix, results_per_page=self.ingest_file_concurrency * 4).by_page():
+                list(executor.map(run, [blob for blob in page if not blob.name.endswith('/')]))
+        # forget uploads deleted since they were checkpointed, the checkpoint blob is deleted once nothing is left in it
+        gone = [(key, path) for key in ('files', 'ingested') for path in checkpoint[key] if path not in listed]
+        if gone:
+            for key, path in gone:
+                del checkpoint[key][path]
+            save_checkpoint(force=True)
+        logging.info(f"ingested {report['files']} files ({report['bytes']} bytes) into production '{production_name}', {len(report['failed'])} failed")
+        return report
 
-        logging.info(self.azcopy_copy(files_url, blob_url))
+    def copy_production_to_blob(self, production_name=None, dry_run=False):
+        # copy produciton storage on files to blob
 
-        # get the current WIP tree on the files volume 
-        wip_production_tree = self.get_wip_production_tree(production_name=production_name)
-        print(wip_production_tree)
+        # copy new and changed files, delete blobs that were deleted from files
+        listings = {}
+        report = self.sync_production_to_blob(production_name=production_name, dry_run=dry_run, listings=listings)
+        if dry_run:
+            return report
 
-        # update production store metadata blob with wip production tree
-        print(self.set_production_tree(production_name=production_name, production_tree=wip_production_tree))
+        # bring the production store metadata tree up to date with the files volume from the sync's listing, journaling only what changed
+        self.refresh_production_tree(production_name=production_name, listings=listings)
+        return report
 
-    def copy_production_to_files(self, production_name=None):
+    def copy_production_to_files(self, production_name=None, dry_run=False):
         # restores blob storage back to production storage
+        if dry_run:
+            return self.sync_production_to_files(production_name=production_name, dry_run=True)
 
-        # recreate the folder structure on the files volume from what was stored in the blob storage
+        # recreate the folder structure on the files volume from what was stored in the blob storage
         self.update_wip_production_tree(production_name=production_name)
 
-        # copy the files:
-        # get blob SAS url
-        blob_url = self.get_blob_sas_url(production_name=production_name)
+        # copy files that are missing or changed on the files volume
+        report = self.sync_production_to_files(production_name=production_name)
 
-        # get files SAS url
-        files_url = self.get_files_sas_url()
+        # update production store metadata tree from the files volume - there shouldn't be any changes
+        self.refresh_production_tree(production_name=production_name)
 
-        # start the copy process
-        logging.info(self.azcopy_copy(files_url, blob_url))
+        # the whole production is on the share again, unless some files failed or are still being rehydrated
+        if not report['failed'] and not report['rehydrate_count']:
+            self.update_production_metadata(production_name, {'online':"True", 'online_paths':None})
+        return report
 
-        # get the current WIP tree on the files volume
-        wip_production_tree = self.get_wip_production_tree(production_name=production_name)
+    ## online and offline lifecycle
 
-        # update production store metadata blob with wip production tree - there shouldn't be any changes
-        self.set_production_tree(production_name=production_name, production_tree=wip_production_tree)
+    # a production's lifecycle is kept in its metadata: 'online' is "True" while the production is on the WIP share, 'online_paths' lists
+    # the folders and files on the share when only part of it has been brought online (a JSON list, absent when the whole production is),
+    # 'archive_tier' is the tier its archived files were moved to when it was taken offline and 'rehydrate_requested' when archived files
+    # were last asked to be rehydrated. how far rehydration has got is read from the blobs themselves by get_production_lifecycle
 
+    def in_paths(self, path, paths):
+        # true when path is one of paths or is under one of them
+        return any(path == p or path.startswith(f"{p.rstrip('/')}/") for p in paths)
+
+    def utc_timestamp(self):
+        from datetime import datetime, timezone
+        return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+    def update_production_metadata(self, production_name, values):
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceModifiedError
+        # set keys of a production's metadata, a value of None removes the key. the write is conditional on the metadata blob not having
+        # changed since it was read, and is read and tried again when it has. metadata cached in store_registry is written against its
+        # etag without reading the blob first, a stale cache costs one failed write
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        metadata_blob_client = container_client.get_blob_client(f"{production_name}/{self.metadata_file_name}")
+        cached = store_registry.get_production_metadata(self.blob_connection_string, self.production_store_id, production_name, with_etag=True) if self.use_cache else None
+        for attempt in range(5):
+            from_cache = cached is not None
+            if from_cache:
+                stored_metadata, etag = cached
+                cached = None
+            else:
+                properties = metadata_blob_client.get_blob_properties()
+                stored_metadata, etag = dict(properties.metadata), properties.etag
+            production_metadata = dict(stored_metadata)
+            for key, value in values.items():
+                if value is None:
+                    production_metadata.pop(key, None)
+                else:
+                    production_metadata[key] = value
+            if production_metadata == stored_metadata:
+                if not from_cache:
+                    return production_metadata
+                # nothing to change according to the cache, which may be stale, so check the blob itself
+                continue
+            try:
+                result = metadata_blob_client.set_blob_metadata(metadata=production_metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+            except ResourceModifiedError:
+                continue
+            store_registry.set_production_metadata(self.blob_connection_string, self.production_store_id, production_name, production_metadata, result['etag'])
+            self.set_production_summary(production_name, production_metadata)
+            return production_metadata
+        raise RuntimeError(f"metadata of production '{production_name}' kept changing, not updated")
+
+    def get_production_online_paths(self, production_name):
+        import json
+        from azure.core.exceptions import ResourceNotFoundError
+        # return the paths of a production that are on the share, None when all of it is, an empty list when it was taken offline
+        try:
+            production_metadata = self.get_production_metadata(production_name)
+        except ResourceNotFoundError:
+            return None
+        if production_metadata.get('online') == "False" and 'archive_tier' in production_metadata:
+            return []
+        if production_metadata.get('online_paths'):
+            return json.loads(production_metadata['online_paths'])
+        return None
+
+    def set_production_blob_tiers(self, production_name, paths, tier, rehydrate_priority=None):
+        # set the access tier of archived files in bulk, 256 blobs to a batch request with batches sent in parallel
+        # setting Hot or Cool on a blob in the Archive tier starts rehydrating it. return the paths that failed
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        batches = [paths[i:i + 256] for i in range(0, len(paths), 256)]
+
+        def set_tiers(batch):
+            blob_names = [f"{production_name}/{path}" for path in batch]
+            responses = container_client.set_standard_blob_tier_blobs(tier, *blob_names, rehydrate_priority=rehydrate_priority, raise_on_any_failure=False)
+            return [path for path, response in zip(batch, responses) if response.status_code >= 300]
+
+        with ContextThreadPoolExecutor(max_workers=self.copy_concurrency) as executor:
+            failed = [path for batch_failed in executor.map(set_tiers, batches) for path in batch_failed]
+        logging.info(f"set tier '{tier}' on {len(paths) - len(failed)} of {len(paths)} files of production '{production_name}'")
+        return failed
+
+    def bring_production_online(self, production_name, folders=None, rehydrate_priority="Standard"):
+        import json
+        # put a production back on the WIP share without restoring all of it: the whole directory skeleton from the production tree is
+        # created, then only the files under folders (online_folders by default, e.g. Sequences and Audio) are copied. everything else stays
+        # in the archive until fetch_production_files asks for it. archived files under folders are rehydrated and copied by calling again
+        if folders is None:
+            folders = self.online_folders
+
+        # the stored tree isn't refreshed, only archived files it already holds are restored
+        self.update_wip_production_tree(production_name=production_name)
+        report = self.sync_production_to_files(production_name=production_name, paths=folders, rehydrate_priority=rehydrate_priority)
+
+        production_metadata = self.get_production_metadata(production_name)
+        if production_metadata.get('online') != "True" or production_metadata.get('online_paths'):
+            # unless it is already wholly online, the folders join whatever part of the production is already online
+            online_paths = json.loads(production_metadata.get('online_paths') or "[]") if production_metadata.get('online') == "True" else []
+            self.update_production_metadata(production_name, {'online':"True", 'online_paths':json.dumps(sorted(set(online_paths) | set(folders)))})
+        report['rehydrating'] = [o['path'] for o in report['operations'] if o['operation'] == 'rehydrate']
+        return report
+
+    def fetch_production_files(self, production_name, paths, rehydrate_priority="Standard"):
+        import json
+        # restore files or folders of a production that is partly online on demand, the paths are added to the production's online paths
+        # so that deleting them from the share later deletes them from the archive too. a production taken offline has its directory
+        # skeleton created first, as bring_production_online does. the online paths are only changed when every copy succeeded
+        online_paths = self.get_production_online_paths(production_name)
+        if online_paths == []:
+            self.update_wip_production_tree(production_name=production_name)
+        report = self.sync_production_to_files(production_name=production_name, paths=paths, rehydrate_priority=rehydrate_priority)
+        if online_paths is not None and not report['failed']:
+            self.update_production_metadata(production_name, {'online':"True", 'online_paths':json.dumps(sorted(set(online_paths) | set(paths)))})
+        report['rehydrating'] = [o['path'] for o in report['operations'] if o['operation'] == 'rehydrate']
+        return report
+
+    def take_production_offline(self, production_name, tier="Cool", remove_wip=False):
+        # archive a production: bring the archive up to date with the share, move every archived file to tier (Cool or Archive) in bulk and,
+        # with remove_wip, delete the production's archived files from the share. nothing is tiered or removed if the archive copy has failures
+        # the metadata, journal and checkpoint blobs stay in the Hot tier so the production can still be listed and read
+        report = {'production_name':production_name, 'tier':tier, 'sync':None, 'wip_removed':False}
+        if self.get_production_online_paths(production_name) != []:
+            report['sync'] = self.copy_production_to_blob(production_name=production_name)
+        if report['sync'] and report['sync'].get('failed'):
+            raise RuntimeError(f"{len(report['sync']['failed'])} files of production '{production_name}' failed to copy to blob, not taking it offline")
+
+        production_blobs = self.list_production_blobs(production_name)
+        paths = [path for path, blob in production_blobs.items() if blob.blob_tier != tier and not blob.archive_status]
+        report['tiered'] = len(paths)
+        report['failed'] = self.set_production_blob_tiers(production_name, paths, tier)
+
+        self.update_production_metadata(production_name, {'online':"False", 'online_paths':None, 'archive_tier':tier})
+        if remove_wip and not report['failed']:
+            report['wip_kept'] = self.remove_archived_wip_files(production_name, production_blobs)
+            report['wip_removed'] = not report['wip_kept']
+        return report
+
+    def remove_archived_wip_files(self, production_name, production_blobs=None):
+        from azure.core.exceptions import HttpResponseError
+        # delete the files of a production from the WIP share that are confirmed archived, those with a blob of the same size whose
+        # wip_last_modified matches the file, then the directories left empty deepest first. uploads in the ingest folder and files written
+        # or changed since they were archived are kept. return the paths of what was kept, an empty list when the whole directory was removed
+        if production_blobs is None:
+            production_blobs = self.list_production_blobs(production_name)
+        directories = []
+        archived = []
+        kept = []
+        for dir_path, file_dir_list in self.walk_wip_directory(production_name, include=['timestamps']):
+            directories.append(dir_path)
+            for file_or_dir in file_dir_list:
+                if file_or_dir['is_directory']:
+                    continue
+                path = f"{dir_path}/{file_or_dir['name']}"[len(production_name) + 1:]
+                blob = production_blobs.get(path) if self.is_archived_file(path) else None
+                if blob is not None and blob.size == file_or_dir['size'] and (blob.metadata or {}).get('wip_last_modified') == str(file_or_dir.get('last_modified')):
+                    archived.append(path)
+                else:
+                    kept.append(path)
+
+        def delete_file(path):
+            try:
+                self.share_client.get_file_client(f"{production_name}/{path}").delete_file()
+            except HttpResponseError as e:
+                logging.error(f"removing '{path}' of production '{production_name}' from the WIP share failed: '{e}'")
+                kept.append(path)
+
+        with ContextThreadPoolExecutor(max_workers=self.copy_concurrency) as executor:
+            list(executor.map(delete_file, archived))
+
+        # a directory still holding a kept file, or anything written to it since it was listed, stays
+        for dir_path in sorted(directories, key=lambda dir_path: dir_path.count('/'), reverse=True):
+            if any(self.in_paths(f"{production_name}/{path}", [dir_path]) for path in kept):
+                continue
+            try:
+                self.share_client.delete_directory(dir_path)
+            except HttpResponseError as e:
+                # e.g. a file written since the listing, the directory is reported as kept with a trailing '/'
+                logging.warning(f"directory '{dir_path}' of production '{production_name}' not removed from the WIP share: '{e}'")
+                kept.append(f"{dir_path[len(production_name) + 1:]}/")
+        if kept:
+            logging.warning(f"{len(kept)} files and directories of production '{production_name}' that aren't archived were left on the WIP share")
+        logging.info(f"removed {len(set(archived) - set(kept))} archived files of production '{production_name}' from the WIP share")
+        return sorted(kept)
+
+    def get_production_lifecycle(self, production_name):
+        import json
+        # return where a production is in its lifecycle: whether it is online and which paths of it, the tier it was archived to, the
+        # count and bytes of its archived files in each tier, and the files still rehydrating with how far they have got
+        production_metadata = self.get_production_metadata(production_name)
+        lifecycle = {
+            'production_name':production_name,
+            'online':production_metadata.get('online') == "True",
+            'online_paths':json.loads(production_metadata['online_paths']) if production_metadata.get('online_paths') else None,
+            'archive_tier':production_metadata.get('archive_tier'),
+            'rehydrate_requested':production_metadata.get('rehydrate_requested'),
+            'tiers':{},
+            'rehydrating':[],
+        }
+        for path, blob in self.list_production_blobs(production_name).items():
+            tier = lifecycle['tiers'].setdefault(str(blob.blob_tier), {'count':0, 'bytes':0})
+            tier['count'] += 1
+            tier['bytes'] += blob.size
+            if blob.archive_status:
+                lifecycle['rehydrating'].append({'path':path, 'archive_status':blob.archive_status})
+        return lifecycle
+
+    ## content index
+
+    # a store wide index of the contents of archived files, kept in one blob at the root of the container as {size:MD5: [blob names]}.
+    # only files storage has a content MD5 for are indexed (uploads, ingested files, and files copied from them), WIP files written over
+    # SMB have none and hashing them would read them through this process. the index is updated by every sync to blob and may lag other
+    # writers, so a duplicate is checked against its blob before it is copied from, and rebuild_content_index recreates it from a listing
+
+    def content_index_blob_name(self):
+        return f"{self.metadata_file_name}.index"
+
+    def md5_string(self, md5):
+        import base64
+        # base64 content MD5 as stored in the index and reports, None when storage has no MD5
+        return base64.b64encode(bytes(md5)).decode() if md5 else None
+
+    def content_key(self, size, md5):
+        if not md5:
+            return None
+        return f"{size}:{md5 if isinstance(md5, str) else self.md5_string(md5)}"
+
+    def get_content_index(self):
+        import json
+        import zlib
+        from azure.core.exceptions import ResourceNotFoundError
+        # return ({key: [blob names]}, etag), ({}, None) when there is no index yet
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        try:
+            downloader = container_client.get_blob_client(self.content_index_blob_name()).download_blob()
+        except ResourceNotFoundError:
+            return {}, None
+        data = downloader.readall()
+        if data[:1] != b'{':
+            data = zlib.decompress(data)
+        return json.loads(data.decode("utf-8"))['entries'], downloader.properties.etag
+
+    def set_content_index(self, entries, etag=None):
+        import json
+        import zlib
+        from azure.core import MatchConditions
+        # write the index, conditional on it not having changed since etag was read, or not existing when etag is None
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        data = zlib.compress(json.dumps({'format':'content_index', 'version':1, 'entries':entries}, separators=(',', ':')).encode("utf-8"))
+        if etag:
+            container_client.upload_blob(name=self.content_index_blob_name(), data=data, overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+        else:
+            container_client.upload_blob(name=self.content_index_blob_name(), data=data, overwrite=False)
+
+    def update_content_index(self, added=None, removed=None, content_index=None):
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+        # remove blob names from the index and add {key: [blob names]}, read and tried again when another writer changed it in between
+        # content_index, {'entries', 'etag'} of an index already read, is tried first rather than reading it again
+        added = added or {}
+        removed = set(removed or [])
+        if not added and not removed:
+            return
+        for attempt in range(5):
+            if attempt == 0 and content_index:
+                entries, etag = content_index['entries'], content_index['etag']
+            else:
+                entries, etag = self.get_content_index()
+            if removed:
+                entries = {key: [name for name in names if name not in removed] for key, names in entries.items()}
+            for key, names in added.items():
+                entries[key] = sorted(set(entries.get(key, [])) | set(names))
+            entries = {key: names for key, names in entries.items() if names}
+            try:
+                self.set_content_index(entries, etag)
+                return
+            except (ResourceExistsError, ResourceModifiedError):
+                continue
+        logging.warning("content index kept changing, not updated, rebuild_content_index will bring it up to date")
+
+    def rebuild_content_index(self):
+        # recreate the index from a listing of every archived file in the store, return the number of files and keys indexed
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        entries = {}
+        files = 0
+        for blob in container_client.list_blobs():
+            if blob.name.startswith(self.summary_prefix()):
+                continue
+            production_name, _, path = blob.name.partition('/')
+            key = self.content_key(blob.size, blob.content_settings.content_md5)
+            if path and key and self.is_archived_file(path):
+                entries.setdefault(key, []).append(blob.name)
+                files += 1
+        _, etag = self.get_content_index()
+        self.set_content_index(entries, etag)
+        logging.info(f"content index rebuilt with {files} files and {len(entries)} distinct contents")
+        return {'files':files, 'contents':len(entries)}
+
+    def find_duplicates(self, production_name, operations, content_index=None):
+        # mark copies whose content is already archived with duplicate_of, the blob to copy from. the MD5 of a WIP file is only read when
+        # the index holds something of its size, so most new files cost no extra requests. blobs the same operations copy over, delete or
+        # move away aren't used. content_index, when given, is filled in with the {'entries', 'etag'} read
+        copies = [o for o in operations if o['operation'] == 'copy' and o['bytes'] >= self.dedup_min_size]
+        if not copies:
+            return
+        entries, etag = self.get_content_index()
+        if content_index is not None:
+            content_index.update(entries=entries, etag=etag)
+        changing = {f"{production_name}/{o['source'] if o['operation'] == 'move' else o['path']}" for o in operations if o['operation'] in ('copy', 'delete', 'move')}
+        sizes = {int(key.split(':', 1)[0]) for key in entries}
+        candidates = [o for o in copies if o['bytes'] in sizes]
+
+        def get_md5(operation):
+            if operation.get('md5'):
+                return operation['md5']
+            file_client = self.share_client.get_file_client(f"{production_name}/{operation['path']}")
+            return self.md5_string(file_client.get_file_properties().content_settings.content_md5)
+
+        with ContextThreadPoolExecutor(max_workers=self.listing_concurrency) as executor:
+            for operation, md5 in zip(candidates, executor.map(get_md5, candidates)):
+                operation['md5'] = md5
+                names = [name for name in entries.get(self.content_key(operation['bytes'], md5), []) if name not in changing]
+                if names:
+                    operation['duplicate_of'] = names[0]
+        logging.info(f"{sum(1 for o in candidates if o.get('duplicate_of'))} of {len(copies)} copies of production '{production_name}' are already archived")
+
+    def copy_duplicate(self, blob_client, operation):
+        # copy a file from the archived blob with the same content, return False (to copy from the share instead) when that blob no longer
+        # holds the content the index says it does
+        from azure.core.exceptions import ResourceNotFoundError
+        source_production, _, source_path = operation['duplicate_of'].partition('/')
+        source_client = self.blob_service_client.get_container_client(str(self.production_store_id)).get_blob_client(operation['duplicate_of'])
+        try:
+            source = source_client.get_blob_properties()
+        except ResourceNotFoundError:
+            source = None
+        if source is None or source.size != operation['bytes'] or self.md5_string(source.content_settings.content_md5) != operation['md5'] or source.blob_tier == 'Archive':
+            logging.info(f"'{operation['duplicate_of']}' no longer matches the index, copying '{operation['path']}' from the share")
+            operation['duplicate_of'] = None
+            return False
+        blob_client.start_copy_from_url(self.sync_url(self.get_blob_sas_url(production_name=source_production, permission="r"), source_path), metadata={'wip_last_modified':operation['last_modified']})
+        self.wait_for_copy(blob_client, blob_client.get_blob_properties)
+        return True
+
+    def index_sync_operations(self, production_name, operations, content_index=None):
+        # bring the index up to date with the copies, moves and deletes of a sync that succeeded. only blobs with an MD5 are indexed, so
+        # the index is left alone, not read or written, when none of the operations add or remove one. content_index is passed on to
+        # update_content_index
+        added = {}
+        removed = []
+        for operation in operations:
+            if operation.get('error') or operation['operation'] not in ('copy', 'move', 'delete'):
+                continue
+            name = f"{production_name}/{operation['path']}"
+            if operation.get('archived_md5'):
+                removed.append(name)
+            if operation['operation'] == 'move' and operation.get('md5'):
+                removed.append(f"{production_name}/{operation['source']}")
+            key = self.content_key(operation['bytes'] or operation.get('moved_bytes', 0), operation.get('md5'))
+            if operation['operation'] != 'delete' and key:
+                added.setdefault(key, []).append(name)
+        self.update_content_index(added, removed, content_index=content_index)
+
+    def get_duplicate_report(self):
+        # return how much storage duplicated contents take across the store: for each production the files and bytes indexed, the files
+        # and bytes whose content is also held elsewhere (in the same or another production) and the productions it shares contents with,
+        # and for the store the bytes that would be saved by keeping one copy of each content
+        entries, _ = self.get_content_index()
+        productions = {}
+        report = {'files':0, 'bytes':0, 'duplicate_files':0, 'reclaimable_bytes':0, 'productions':productions}
+        for key, names in entries.items():
+            size = int(key.split(':', 1)[0])
+            holders = {name.split('/', 1)[0] for name in names}
+            report['files'] += len(names)
+            report['bytes'] += size * len(names)
+            report['reclaimable_bytes'] += size * (len(names) - 1)
+            for name in names:
+                production = productions.setdefault(name.split('/', 1)[0], {'files':0, 'bytes':0, 'duplicate_files':0, 'duplicate_bytes':0, 'shared_with':set()})
+                production['files'] += 1
+                production['bytes'] += size
+                if len(names) > 1:
+                    report['duplicate_files'] += 1
+                    production['duplicate_files'] += 1
+                    production['duplicate_bytes'] += size
+                    production['shared_with'] |= holders - {name.split('/', 1)[0]}
+        for production in productions.values():
+            production['shared_with'] = sorted(production['shared_with'])
+        return report
+
+    ## batch operations
+
+    # operations run_batch accepts, with the number of each that may run at once by default
+    batch_operations = {
+        'copy_production_to_blob': 2,
+        'copy_production_to_files': 2,
+        'refresh_production_tree': 4,
+        'ingest_production': 4,
+        'bring_production_online': 2,
+        'take_production_offline': 2,
+        'get_production_lifecycle': 16,
+        'update_wip_production_tree': 4,
+        'set_production_upload_pin': 16,
+        'get_production_metadata': 16,
+        'get_blob_sas_url': 16,
+        'get_files_sas_url': 16,
+        'get_blob_sas_urls': 16,
+        'get_files_sas_urls': 16,
+    }
+
+    def call_with_retries(self, function, *args, **kwargs):
+        import time
+        import random
+        from azure.core.exceptions import HttpResponseError
+        # call function, retrying with exponential backoff and jitter while storage is throttling (429) or busy (503)
+        # return (result, attempts)
+        attempt = 1
+        while True:
+            try:
+                return function(*args, **kwargs), attempt
+            except HttpResponseError as e:
+                if e.status_code not in (429, 503) or attempt > self.batch_retries:
+                    raise e
+                delay = min(self.batch_backoff * 2 ** (attempt - 1), 60) * random.uniform(0.5, 1.5)
+                logging.warning(f"storage throttled {getattr(function, '__name__', function)} with status {e.status_code}, retrying in {delay:.1f}s (attempt {attempt} of {self.batch_retries})")
+                time.sleep(delay)
+                attempt += 1
+
+    def run_batch(self, items, concurrency=None):
+        import time
+        from concurrent.futures import wait, FIRST_COMPLETED
+        # run operations across many productions on one shared worker pool and return a report with a result for every item
+        # items are dicts of {'operation', 'production_name', and optionally 'kwargs'}, operation is one of batch_operations
+        # concurrency overrides the per operation limits in batch_operations, e.g. {'copy_production_to_blob': 4}, but doesn't make any other
+        # operation runnable. an item is only handed to the pool once its operation is under its limit, so items waiting on a busy operation
+        # don't hold workers other operations could use
+        limits = {operation: (concurrency or {}).get(operation, limit) for operation, limit in self.batch_operations.items()}
+
+        def run(item):
+            result = {'production_name':item['production_name'], 'operation':item['operation'], 'status':'failed', 'attempts':0}
+            start = time.perf_counter()
+            try:
+                function = getattr(self, item['operation'])
+                result['result'], result['attempts'] = self.call_with_retries(function, production_name=item['production_name'], **item.get('kwargs', {}))
+                failed = result['result'].get('failed') if isinstance(result['result'], dict) else None
+                if failed:
+                    # the operation finished but some of its files didn't, e.g. a sync with copies that failed
+                    result['error'] = f"{len(failed)} files failed"
+                else:
+                    result['status'] = 'succeeded'
+            except Exception as e:
+                logging.error(f"batch {item['operation']} of '{item['production_name']}' failed: '{e}'")
+                result['error'] = str(e)
+            result['seconds'] = time.perf_counter() - start
+            return result
+
+        results = [None] * len(items)
+        # indexes of the items waiting to start, by operation in the order they were given, and the operation of each running item
+        waiting = {}
+        for index, item in enumerate(items):
+            if item['operation'] in limits:
+                waiting.setdefault(item['operation'], collections.deque()).append(index)
+            else:
+                results[index] = {'production_name':item['production_name'], 'operation':item['operation'], 'status':'failed', 'attempts':0, 'seconds':0.0,
+                                  'error':f"unknown batch operation '{item['operation']}'"}
+        running = {}
+        running_count = {operation: 0 for operation in waiting}
+
+        batch_start = time.perf_counter()
+        with ContextThreadPoolExecutor(max_workers=self.batch_concurrency) as executor:
+            while waiting or running:
+                # start items a round at a time across operations, so one operation's items don't take every free worker
+                started = True
+                while started and len(running) < self.batch_concurrency:
+                    started = False
+                    for operation in list(waiting):
+                        if len(running) >= self.batch_concurrency or running_count[operation] >= max(1, limits[operation]):
+                            continue
+                        index = waiting[operation].popleft()
+                        if not waiting[operation]:
+                            del waiting[operation]
+                        running[executor.submit(run, items[index])] = (index, operation)
+                        running_count[operation] += 1
+                        started = True
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, operation = running.pop(future)
+                    running_count[operation] -= 1
+                    results[index] = future.result()
+        report = {
+            'results':results,
+            'succeeded':sum(1 for result in results if result['status'] == 'succeeded'),
+            'failed':sum(1 for result in results if result['status'] == 'failed'),
+            'seconds':time.perf_counter() - batch_start,
+        }
+        logging.info(f"batch of {len(items)} operations finished in {report['seconds']:.1f}s, {report['succeeded']} succeeded, {report['failed']} failed")
+        return report
+
+class AsyncProductionStore(ProductionStoreSettings):
+    # asyncio version of ProductionStore built on the aio storage clients, storage requests are awaited rather than holding a worker thread
+    # (the 'instrumentation' setting only applies to ProductionStore)
+    # use as 'async with AsyncProductionStore(...) as production_store:' or call open() and close()
+    def __init__(self, blob_connection_string=None, file_connection_string=None, production_store_id=None, production_store_name=None, use_cache=True):
+        from azure.storage.blob.aio import BlobServiceClient
+
+        # aio clients are bound to the event loop they were opened on, so only the settings, store names, production metadata and SAS tokens
+        # are shared through store_registry
+        self.load_settings(blob_connection_string, file_connection_string, production_store_id, production_store_name, use_cache)
+
+        # blob storage connection, no requests are made until open()
+        logging.info("init connection to blob storage")
+        self.blob_service_client = BlobServiceClient.from_connection_string(self.blob_connection_string)
+        self.share_client = None
+
+    async def open(self):
+        from azure.storage.fileshare.aio import ShareClient
+
+        if self.production_store_id:
+            await self.get_production_store()
+        else:
+            await self.create_production_store()
+
+        # file service connetion, needs the production store name
+        logging.info("init connection to file service")
+        self.share_client = ShareClient.from_connection_string(self.file_connection_string, share_name=self.production_store_name)
+        return self
+
+    async def close(self):
+        await self.blob_service_client.close()
+        if self.share_client:
+            await self.share_client.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get_production_store(self):
+        # Read a 'Production Store' container and it's metadata, the name is taken from the process cache when it has been looked up recently
+        if self.use_cache:
+            production_store_name = store_registry.get_store_name(self.blob_connection_string, self.production_store_id)
+            if production_store_name:
+                self.production_store_name = production_store_name
+                return
+
+        container_client = self.blob_service_client.get_container_client(self.production_store_id)
+        container_properties = await container_client.get_container_properties()
+        try:
+            self.production_store_name = container_properties.metadata['production_store_name']
+            store_registry.set_store_name(self.blob_connection_string, self.production_store_id, self.production_store_name)
+        except:
+            logging.error("Error")
+
+    async def create_production_store(self):
+        from azure.core.exceptions import ResourceExistsError
+
+        if self.production_store_name:
+            # Create a unique name for the container
+            self.production_store_id = str(uuid.uuid4())
+
+            # Create the container
+            logging.info(f"Creating Blob Container for production store name '{self.production_store_name}' named '{self.production_store_id}'")
+            container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+
+            try:
+                await container_client.create_container()
+            except ResourceExistsError :
+                logging.error(f"Container '{self.production_store_id}' named already exists")
+
+            await container_client.set_container_metadata(metadata=self.metadata())
+            store_registry.set_store_name(self.blob_connection_string, self.production_store_id, self.production_store_name)
+        else:
+            logging.error("Missing parameter: production_store_name")
+
+    async def list_productions(self):
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        productions = []
+        async for blob in container_client.walk_blobs():
+            if blob.name.endswith('/') and blob.name != self.summary_prefix():
+                productions.append(blob.name[:-1])
+        return productions
+
+    async def create_production(self, production_name, production_tree=None):
+        from azure.core.exceptions import ResourceExistsError
+        production_id = str(uuid.uuid4())
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        logging.info(f"creating projection named '{production_name}'")
+        try:
+            if production_tree:
+                blob_data = self.encode_production_tree(self.production_root(production_name, production_tree))
+            else:
+                # use the class default production
+                blob_data = self.encode_production_tree(self.production_root(production_name, self.default_production_tree))
+
+            production_metadata = {"production_id":production_id, "online":"False"}
+            blob_name = f"{production_name}/{self.metadata_file_name}"
+            await container_client.upload_blob(data=blob_data, name=blob_name, metadata=production_metadata)
+            await self.set_production_summary(production_name, production_metadata)
+        except ResourceExistsError:
+            logging.error(f"The production named '{production_name}' already exists.")
+
+    async def get_production_metadata(self, production_name):
+        # return metadata about a production
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+            metadata_blob_name = f"{production_name}/{self.metadata_file_name}"
+            metadata_blob_client = container_client.get_blob_client(metadata_blob_name)
+            properties = await metadata_blob_client.get_blob_properties()
+            store_registry.set_production_metadata(self.blob_connection_string, self.production_store_id, production_name, properties.metadata, properties.etag)
+            return properties.metadata
+        except ResourceNotFoundError as e:
+            logging.error(f"metadata blob: '{metadata_blob_name}' for production '{production_name}' is missing")
+            raise e
+
+    async def get_production_tree(self, production_name):
+        # return the tree from the production medata blob about a production, the journal is read first as in ProductionStore
+        from azure.core.exceptions import ResourceNotFoundError
+        deltas = await self.get_production_tree_deltas(production_name)
+        try:
+            container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+            metadata_blob_name = f"{production_name}/{self.metadata_file_name}"
+            metadata_blob_client = container_client.get_blob_client(metadata_blob_name)
+            production_tree = self.production_root(production_name, CompactProductionTree.loads(await (await metadata_blob_client.download_blob()).readall()).to_tree())
+            # apply any changes journaled since the tree was last written in full
+            return self.apply_tree_deltas(production_tree, deltas)
+        except ResourceNotFoundError as e:
+            logging.error(f"metadata blob: '{metadata_blob_name}' for production '{production_name}' is missing")
+            raise e
+
+    async def get_production_tree_deltas(self, production_name):
+        import json
+        from azure.core.exceptions import ResourceNotFoundError
+        # return the records in the production's tree journal, an empty list when nothing has been journaled since the last full write
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        try:
+            journal = await (await container_client.get_blob_client(self.journal_blob_name(production_name)).download_blob()).readall()
+        except ResourceNotFoundError:
+            return []
+        return [json.loads(line) for line in journal.decode("utf-8").splitlines() if line]
+
+    async def set_production_tree(self, production_name, production_tree):
+        # write the whole tree back to the metadata blob
+        from azure.core.exceptions import ResourceNotFoundError
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        production_metadata = await self.get_production_metadata(production_name)
+        blob_data = self.encode_production_tree(production_tree)
+        blob_name = f"{production_name}/{self.metadata_file_name}"
+        await container_client.upload_blob(data=blob_data, name=blob_name, metadata=production_metadata, overwrite=True)
+        store_registry.forget_production_metadata(self.blob_connection_string, self.production_store_id, production_name)
+        # the full tree now includes every journaled change
+        try:
+            await container_client.get_blob_client(self.journal_blob_name(production_name)).delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+    async def set_production_upload_pin(self, production_name):
+        from random import choice
+        from string import digits
+        upload_pin = ''.join(choice(digits) for i in range(6))
+        await self.update_production_metadata(production_name, {'upload_pin':upload_pin})
+        return upload_pin
+
+    async def update_production_metadata(self, production_name, values):
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceModifiedError
+        # set keys of a production's metadata conditionally on the blob not having changed, as ProductionStore.update_production_metadata
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        metadata_blob_client = container_client.get_blob_client(f"{production_name}/{self.metadata_file_name}")
+        cached = store_registry.get_production_metadata(self.blob_connection_string, self.production_store_id, production_name, with_etag=True) if self.use_cache else None
+        for attempt in range(5):
+            from_cache = cached is not None
+            if from_cache:
+                stored_metadata, etag = cached
+                cached = None
+            else:
+                properties = await metadata_blob_client.get_blob_properties()
+                stored_metadata, etag = dict(properties.metadata), properties.etag
+            production_metadata = dict(stored_metadata)
+            for key, value in values.items():
+                if value is None:
+                    production_metadata.pop(key, None)
+                else:
+                    production_metadata[key] = value
+            if production_metadata == stored_metadata:
+                if not from_cache:
+                    return production_metadata
+                # nothing to change according to the cache, which may be stale, so check the blob itself
+                continue
+            try:
+                result = await metadata_blob_client.set_blob_metadata(metadata=production_metadata, etag=etag, match_condition=MatchConditions.IfNotModified)
+            except ResourceModifiedError:
+                continue
+            store_registry.set_production_metadata(self.blob_connection_string, self.production_store_id, production_name, production_metadata, result['etag'])
+            await self.set_production_summary(production_name, production_metadata)
+            return production_metadata
+        raise RuntimeError(f"metadata of production '{production_name}' kept changing, not updated")
+
+    async def set_production_summary(self, production_name, production_metadata):
+        from azure.core.exceptions import HttpResponseError
+        # write the summary blob listed by ProductionStore.list_productions_page, a failed write is only logged
+        container_client = self.blob_service_client.get_container_client(str(self.production_store_id))
+        try:
+            await container_client.upload_blob(name=self.summary_blob_name(production_name), data=b"", metadata=production_metadata, overwrite=True)
+        except HttpResponseError as e:
+            logging.warning(f"summary of production '{production_name}' not updated: '{e}'")
+
+    async def get_ingest_url(self, production_name, pin):
+        # verity upload pin, return URL
+        logging.info(f"getting metadata for production '{production_name}'")
+        production_metadata = await self.get_production_metadata(production_name)
+        if pin == production_metadata['upload_pin']:
+            #pin matches, return URL. the SAS covers the whole container, so uploaders can only create new blobs with it, not overwrite,
+            #list, read or delete what is archived
+            return self.get_blob_sas_url(production_name=production_name, path=self.ingest_prefix, permission="c")
+        else:
+            logging.error("Upload PIN missmatch")
+
+    ## Files operations
+
+    async def get_wip_production_tree(self, production_name):
+        # return a tree of the production wip directory
+        return [({'name':production_name, 'type':'directory', 'contents':await self.get_wip_directory(production_name)})]
+
+    async def get_wip_directory(self, path=""):
+        import asyncio
+        from azure.core.exceptions import ResourceNotFoundError
+        # return the tree under path, listing every directory in a level concurrently, at most listing_concurrency at once
+        semaphore = asyncio.Semaphore(self.listing_concurrency)
+
+        async def list_directory(dir_path):
+            async with semaphore:
+                try:
+                    return [file_or_dir async for file_or_dir in self.share_client.list_directories_and_files(directory_name=dir_path)]
+                except ResourceNotFoundError as e:
+                    logging.error(f"Directory does not exist '{self.share_client.share_name}/{dir_path}', error: '{e}'")
+                    raise e
+
+        tree = []
+        level = [(path, tree)]
+        while level:
+            listings = await asyncio.gather(*[list_directory(dir_path) for dir_path, contents in level])
+            next_level = []
+            for (dir_path, contents), file_dir_list in zip(level, listings):
+                next_level.extend(self.add_wip_listing(dir_path, contents, file_dir_list))
+            logging.info(f"Listed {len(level)} directories under '{path}'")
+            level = next_level
+        return tree
 
-        # TODO delete blobs that were deleted from files
-        # TODO detect folder movements and update paths only, not copy
-        # TODO sync blob to files
 
-        
 # create a new production store
 # production_store = ProductionStore(blob_connection_string=azstorage_connection_str, production_store_name="New Store"
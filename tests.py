@@ -1,4 +1,5 @@
-from productions import ProductionStore
+import asyncio
+from productions import ProductionStore, AsyncProductionStore, StorageMetrics, MemoryMetricsSink
 
 def test_productions(name=None):
     from random import choice
@@ -19,6 +20,9 @@ def test_productions(name=None):
     production_store.create_production(name)
     print(production_store.list_productions())
 
+    print("TEST: list productions page with metadata")
+    print(production_store.list_productions_page(name_prefix=production_name[:1], page_size=10, include_metadata=True))
+
     print("TEST: get production metadata")
     print(production_store.get_production_metadata(production_name))
 
@@ -31,6 +35,9 @@ def test_productions(name=None):
     print("TEST: get production tree")
     print(production_store.get_production_tree(production_name=production_name))
 
+    print("TEST: list production directory from the tree index")
+    print(production_store.list_production_directory(production_name=production_name))
+
     print("TEST: update wip production tree")
     production_store.update_wip_production_tree(production_name)
 
@@ -41,9 +48,24 @@ def test_productions(name=None):
     print("TEST: update production store metadata blob with wip production tree")
     print(production_store.set_production_tree(production_name=production_name, production_tree=wip_production_tree))
 
+    print("TEST: refresh production tree from the wip directory")
+    print(production_store.refresh_production_tree(production_name=production_name))
+
     print("TEST: get SAS token from files")
     print(production_store.get_files_sas_url(production_name=production_name))
 
+    print("TEST: get SAS urls for files in the production")
+    print(production_store.get_blob_sas_urls(production_name=production_name, paths=["Sequences/edit.prproj", "Audio/mix.wav"]))
+
+    print("TEST: bring production online with the default folders")
+    print(production_store.bring_production_online(production_name=production_name)['rehydrating'])
+
+    print("TEST: get production lifecycle")
+    print(production_store.get_production_lifecycle(production_name=production_name))
+
+    print("TEST: report duplicate storage across productions")
+    print(production_store.get_duplicate_report())
+
 
 def test_copy_functions(name = None):
     production_store = ProductionStore(production_store_id="91566e5d-9644-48b4-b664-1b3c6f744af7")
@@ -63,13 +85,55 @@ def test_copy_functions(name = None):
     files_url = production_store.get_files_sas_url(production_name=production_name)
     print (f"files_url = '{files_url}'")
 
+    print("TEST: dry run copy from files to blob")
+    print(production_store.copy_production_to_blob(production_name=name, dry_run=True))
+
     print("TEST: copy from blob to files")
     production_store.copy_production_to_files(production_name=name)
 
     print("TEST: copy from blob to files")
     production_store.copy_production_to_blob(production_name=name)
 
+    print("TEST: storage requests per operation of an instrumented copy from files to blob")
+    metrics = StorageMetrics([MemoryMetricsSink()])
+    instrumented_store = ProductionStore(production_store_id="91566e5d-9644-48b4-b664-1b3c6f744af7", metrics=metrics)
+    instrumented_store.copy_production_to_blob(production_name=name)
+    for operation, totals in metrics.sink(MemoryMetricsSink).snapshot()['operations'].items():
+        print(f"{operation}: {totals['calls']} calls, {totals['requests']} requests, {totals['retries']} retries, {totals['throttled']} throttled, {totals['seconds']:.2f}s")
+
+
+
+async def test_async_productions(name):
+    # the same checks as test_productions, run against the async store to compare the results with the sync store
+    production_store = ProductionStore(production_store_id="91566e5d-9644-48b4-b664-1b3c6f744af7")
+
+    async with AsyncProductionStore(production_store_id="91566e5d-9644-48b4-b664-1b3c6f744af7") as async_production_store:
+        print("TEST: async list productions")
+        assert await async_production_store.list_productions() == production_store.list_productions()
+
+        print("TEST: async get production metadata")
+        assert await async_production_store.get_production_metadata(name) == production_store.get_production_metadata(name)
+
+        print("TEST: async reset upload PIN")
+        production_pin = await async_production_store.set_production_upload_pin(name)
+        assert production_store.get_production_metadata(name)['upload_pin'] == production_pin
+
+        print("TEST: async get ingest url")
+        print(await async_production_store.get_ingest_url(production_name=name, pin=production_pin))
+
+        print("TEST: async get production tree")
+        production_tree = await async_production_store.get_production_tree(production_name=name)
+        assert production_tree == production_store.get_production_tree(production_name=name)
+
+        print("TEST: async get wip production tree")
+        wip_production_tree = await async_production_store.get_wip_production_tree(production_name=name)
+        assert wip_production_tree == production_store.get_wip_production_tree(production_name=name)
+
+        print("TEST: async update production store metadata blob with wip production tree")
+        await async_production_store.set_production_tree(production_name=name, production_tree=wip_production_tree)
+
 
 
 test_productions(name="qanbdvtzvxmp")
-test_copy_functions(name = "qanbdvtzvxmp")
\ No newline at end of file
+test_copy_functions(name = "qanbdvtzvxmp")
+asyncio.run(test_async_productions(name="qanbdvtzvxmp"))
\ No newline at end of file